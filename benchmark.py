@@ -0,0 +1,308 @@
+import argparse
+import csv
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from csv_ingest import FIELDS
+
+REPO_DIR = Path(__file__).resolve().parent
+DEFAULT_ROWS = [1, 100, 1000, 10000]
+DEFAULT_OUTPUT = 'benchmark_results.json'
+
+DEPARTMENTS = ['Personal', 'Finanzen', 'IT', 'Vertrieb', 'Forschung']
+DEVICES = ['Laptop', 'Monitor', 'Headset', 'Schlüssel', 'Diensthandy']
+ACCESS = ['Workspace', 'Nextcloud', 'Jira', 'Confluence', 'VPN']
+SOFTWARE = ['Office', 'Adobe Reader', 'Zoom', 'Slack']
+STANDARD_ACCESS = ['HR Works', 'Intranet', 'Zeiterfassung']
+
+
+def synthetic_row(index):
+    """Return one synthetic onboarding row, as a dict keyed by the German CSV headers."""
+    def pick(options, count):
+        # A multi-line cell with count entries, rotating through the options per row
+        return '\n'.join(options[(index + offset) % len(options)] for offset in range(count))
+
+    values = {
+        'name': f'Vorname{index} Nachname{index}',
+        'berufsbezeichnung': 'Sachbearbeitung',
+        'abteilung': DEPARTMENTS[index % len(DEPARTMENTS)],
+        'email': f'person{index}@example.com',
+        'vertragsbeginn': '01.01.2025',
+        'uebergabedatum': '02.01.2025',
+        'gruppenpostfaecher': 'Ja' if index % 2 else 'Nein',
+        'arbeitsgeraete': pick(DEVICES, 3),
+        'zugaenge': pick(ACCESS, 2),
+        'software': pick(SOFTWARE, 2),
+        'standard_zugaenge': pick(STANDARD_ACCESS, 2),
+        'standard_ressourcen': 'Drucker 1. OG',
+        'telefon': f'{10 + index % 80}',
+        'softwarewunsch': '',
+        'bemerkungen': '',
+        'vereinbarung': 'Ja',
+        'unterschrift': f'Vorname{index} Nachname{index}',
+    }
+    return {header: values[attribute] for attribute, header, _ in FIELDS}
+
+
+def synthetic_csv(rows):
+    """
+    Build a synthetic onboarding CSV with the real column headers.
+
+    Args:
+        rows (int): Number of data rows.
+
+    Returns:
+        bytes: The UTF-8 encoded CSV file.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=[header for _, header, _ in FIELDS])
+    writer.writeheader()
+    for index in range(rows):
+        writer.writerow(synthetic_row(index))
+    return buffer.getvalue().encode('utf-8')
+
+
+def percentile(values, fraction):
+    """Return the given percentile (0..1) of a list of numbers using linear interpolation."""
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class StageTimer:
+    """Records the start and end time of every item a pipeline stage handles."""
+
+    def __init__(self):
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def wrap(self, name, function):
+        """Return function wrapped so that every call is recorded under the stage name."""
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                with self.lock:
+                    self.timings.setdefault(name, []).append((start, end))
+        return timed
+
+    def span(self, name):
+        """Return the seconds from the first start to the last end of a stage, or 0 if it never ran."""
+        timings = self.timings.get(name)
+        if not timings:
+            return 0.0
+        return max(end for _, end in timings) - min(start for start, _ in timings)
+
+    def summary(self):
+        """Return count, p50, p95 and max latency in milliseconds per stage."""
+        summary = {}
+        for name, timings in self.timings.items():
+            durations = [(end - start) * 1000 for start, end in timings]
+            summary[name] = {
+                'count': len(durations),
+                'p50_ms': round(percentile(durations, 0.5), 3),
+                'p95_ms': round(percentile(durations, 0.95), 3),
+                'max_ms': round(max(durations), 3),
+            }
+        return summary
+
+
+def run_once(rows):
+    """
+    Run the pipeline once for a synthetic CSV, inside the current (scratch) working directory.
+
+    The IMAP, SMTP and Nextcloud servers are local stand-ins started in this process, and the real pipeline
+    stages are used for everything in between. Must run in a fresh process, as main.py reads its
+    configuration when it is imported.
+
+    Args:
+        rows (int): Number of rows in the synthetic CSV.
+
+    Returns:
+        dict: The measurements of this run.
+    """
+    from benchmark_servers import ImapStandIn, SmtpStandIn, WebDavStandIn
+
+    imap, smtp, webdav = ImapStandIn(), SmtpStandIn(), WebDavStandIn()
+    os.environ.update({
+        'IMAP_SERVER': '127.0.0.1', 'IMAP_PORT': str(imap.port), 'IMAP_SSL': 'false',
+        'SMTP_SERVER': '127.0.0.1', 'EMAIL_PORT': str(smtp.port), 'SMTP_SSL': 'false',
+        'EMAIL_ACCOUNT': 'benchmark@example.com', 'PASSWORD': 'benchmark', 'MAILBOX': 'INBOX',
+        'MINUTH_EMAIL': 'minuth@example.com', 'DRITICH_EMAIL': 'dittrich@example.com',
+        'TEMPLATES_DIR': str(REPO_DIR / 'templates'), 'EMAIL_TEXT_DIR': str(REPO_DIR / 'email_text'),
+        'ATTACHMENTS_DIR': 'attachments', 'ONBOARDED_DIR': 'onboarded_person',
+        'TEMPLATE_CACHE_DIR': 'template_cache', 'LEDGER_FILE': 'processing_ledger.json',
+        'NEXTCLOUD_BASE_URL': webdav.base_url('benchmark'), 'NEXTCLOUD_USERNAME': 'benchmark',
+        'NEXTCLOUD_PASSWORD': 'benchmark', 'NEXTCLOUD_DIRECTORY': 'onboarding', 'SYNC_STATE_FILE': 'sync_state.db',
+    })
+    # Throttling would only measure the configured rate, so it is lifted unless set explicitly
+    os.environ.setdefault('SMTP_RATE', '1000')
+    os.environ.setdefault('SMTP_BURST', '1000')
+
+    import main
+    import pipeline
+
+    imap.add_csv_message('Onboarding export', f'onboarding_{rows}.csv', synthetic_csv(rows))
+
+    timer = StageTimer()
+    service = pipeline.OnboardingPipeline()
+    for stage in service.stages:
+        stage.handler = timer.wrap(stage.name, stage.handler)
+    main.fetch_csv_section = timer.wrap('fetch', main.fetch_csv_section)
+    service.start()
+
+    started = time.perf_counter()
+    mail = main.connect_imap()
+    main.process_unseen_emails(mail, service.submit_attachment)
+    mail.logout()
+    service.stop()
+    elapsed = time.perf_counter() - started
+
+    upload_span = timer.span('upload')
+    letters = len(os.listdir(main.ONBOARDED_DIR))
+    result = {
+        'rows': rows,
+        'letters': letters,
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(rows / elapsed, 3),
+        'stages': timer.summary(),
+        # ru_maxrss is in kilobytes on Linux; the children are the wkhtmltopdf processes
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'peak_child_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        'upload': {
+            'files': len(webdav.files),
+            'bytes': webdav.bytes_received,
+            'mb_per_second': round(webdav.bytes_received / upload_span / 1e6, 3) if upload_span else None,
+        },
+        'emails_sent': smtp.delivered,
+        'config': {
+            'RENDER_WORKERS': main.RENDER_WORKERS,
+            'RENDER_POOL': main.RENDER_POOL,
+            'RENDER_MODE': main.RENDER_MODE,
+            'RENDER_BATCH_SIZE': main.RENDER_BATCH_SIZE,
+            'PIPELINE_QUEUE_SIZE': pipeline.PIPELINE_QUEUE_SIZE,
+            'UPLOAD_WORKERS': pipeline.syn_nextcloud.UPLOAD_WORKERS,
+        },
+    }
+    for server in (imap, smtp, webdav):
+        server.shutdown()
+    return result
+
+
+def run_in_subprocess(rows, verbose=False):
+    """
+    Run one benchmark in a fresh Python process and scratch directory, so runs do not share caches or peak RSS.
+
+    Args:
+        rows (int): Number of rows in the synthetic CSV.
+        verbose (bool): Show the pipeline's output instead of discarding it.
+
+    Returns:
+        dict: The measurements reported by run_once.
+    """
+    with tempfile.TemporaryDirectory(prefix='onboarding-benchmark-') as workdir:
+        command = [sys.executable, str(Path(__file__).resolve()), '--child', str(rows)]
+        if verbose:
+            command.append('--verbose')
+        completed = subprocess.run(command, cwd=workdir, stdout=subprocess.PIPE, check=True)
+    return json.loads(completed.stdout.decode().strip().splitlines()[-1])
+
+
+def compare(results, baseline, max_regression):
+    """
+    Compare rows/s with an earlier run and report regressions.
+
+    Args:
+        results (dict): The results of this run.
+        baseline (dict): The results of the earlier run.
+        max_regression (float): Allowed relative drop in rows/s, e.g. 0.1 for 10 %.
+
+    Returns:
+        bool: True if no size regressed by more than max_regression.
+    """
+    previous = {run['rows']: run for run in baseline['runs']}
+    passed = True
+    for run in results['runs']:
+        before = previous.get(run['rows'])
+        if before is None:
+            continue
+        change = run['rows_per_second'] / before['rows_per_second'] - 1
+        regressed = change < -max_regression
+        passed = passed and not regressed
+        print(f"{run['rows']:>6} rows: {before['rows_per_second']:.2f} -> {run['rows_per_second']:.2f} rows/s "
+              f"({change:+.1%}){'  REGRESSION' if regressed else ''}")
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmark of the onboarding pipeline.')
+    parser.add_argument('--rows', type=int, nargs='+', default=DEFAULT_ROWS, help='CSV sizes to benchmark')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='JSON file the results are written to')
+    parser.add_argument('--compare', metavar='BASELINE', help='earlier results file to compare rows/s against')
+    parser.add_argument('--max-regression', type=float, default=0.1, help='allowed drop in rows/s (default 0.1)')
+    parser.add_argument('--verbose', action='store_true', help="show the pipeline's output")
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        output = sys.stdout
+        if args.verbose:
+            import metrics
+            metrics.setup_logging()
+        else:
+            sys.stdout = open(os.devnull, 'w')
+        result = run_once(args.child)
+        output.write(json.dumps(result) + '\n')
+        return
+
+    # wkhtmltopdf is the one external program the pipeline needs
+    wkhtmltopdf = os.getenv('WKHTMLTOPDF_PATH') or shutil.which('wkhtmltopdf')
+    if not wkhtmltopdf:
+        sys.exit('wkhtmltopdf was not found; install it or set WKHTMLTOPDF_PATH.')
+    os.environ['WKHTMLTOPDF_PATH'] = wkhtmltopdf
+
+    results = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'runs': [],
+    }
+    for rows in args.rows:
+        run = run_in_subprocess(rows, args.verbose)
+        results['runs'].append(run)
+        stages = ', '.join(f"{name} p50 {stage['p50_ms']:.1f} / p95 {stage['p95_ms']:.1f} ms"
+                           for name, stage in run['stages'].items())
+        print(f"{rows:>6} rows: {run['rows_per_second']:.2f} rows/s in {run['seconds']:.1f} s, "
+              f"peak RSS {run['peak_rss_mb']} MB (+{run['peak_child_rss_mb']} MB wkhtmltopdf), "
+              f"upload {run['upload']['mb_per_second']} MB/s; {stages}")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
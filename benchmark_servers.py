@@ -0,0 +1,296 @@
+import base64
+import hashlib
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote, urlparse
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _serve(server):
+    thread = threading.Thread(target=server.serve_forever, name=type(server).__name__, daemon=True)
+    thread.start()
+    return server
+
+
+class ImapStandIn:
+    """
+    Minimal in-process IMAP server holding a fixed set of unread messages with one CSV attachment each.
+
+    Supports the commands main.py uses: CAPABILITY, LOGIN, SELECT, UID SEARCH UNSEEN, UID FETCH of
+    BODYSTRUCTURE, the Subject header and single body sections, UID STORE, NOOP and LOGOUT.
+    Connections are plain TCP on 127.0.0.1.
+    """
+
+    def __init__(self):
+        self.messages = {}
+        self.lock = threading.Lock()
+        stand_in = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                stand_in._handle(self.rfile, self.wfile)
+
+        self.server = _serve(_ThreadingTCPServer(('127.0.0.1', 0), Handler))
+        self.port = self.server.server_address[1]
+
+    def add_csv_message(self, subject, filename, csv_bytes):
+        """Add an unread message with a base64-encoded CSV attachment and return its UID."""
+        encoded = base64.encodebytes(csv_bytes).replace(b'\n', b'\r\n')
+        text = b'Please find the onboarding export attached.\r\n'
+        lines = encoded.count(b'\r\n')
+        structure = (
+            f'(("text" "plain" ("charset" "utf-8") NIL NIL "7bit" {len(text)} 1 NIL NIL NIL NIL)'
+            f'("text" "csv" ("charset" "utf-8" "name" "{filename}") NIL NIL "base64" {len(encoded)} '
+            f'{lines} NIL ("attachment" ("filename" "{filename}")) NIL NIL) "mixed" NIL NIL NIL NIL)'
+        )
+        with self.lock:
+            uid = len(self.messages) + 1
+            self.messages[uid] = {
+                'seen': False,
+                'structure': structure.encode(),
+                'header': f'Subject: {subject}\r\n\r\n'.encode(),
+                'sections': {'1': text, '2': encoded},
+            }
+        return uid
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handle(self, rfile, wfile):
+        wfile.write(b'* OK IMAP4rev1 stand-in ready\r\n')
+        while True:
+            line = rfile.readline()
+            if not line:
+                return
+            tag, _, command = line.decode().rstrip('\r\n').partition(' ')
+            name, _, args = command.partition(' ')
+            name = name.upper()
+            if name == 'UID':
+                name, _, args = args.partition(' ')
+                name = 'UID ' + name.upper()
+
+            if name == 'CAPABILITY':
+                wfile.write(b'* CAPABILITY IMAP4rev1\r\n')
+            elif name == 'SELECT':
+                with self.lock:
+                    wfile.write(f'* {len(self.messages)} EXISTS\r\n'.encode())
+            elif name == 'UID SEARCH':
+                with self.lock:
+                    unseen = [str(uid) for uid, message in self.messages.items() if not message['seen']]
+                wfile.write(f"* SEARCH {' '.join(unseen)}\r\n".encode())
+            elif name == 'UID FETCH':
+                uids, _, items = args.partition(' ')
+                for uid in uids.split(','):
+                    wfile.write(self._fetch_response(int(uid), items.upper()))
+            elif name == 'UID STORE':
+                uid = int(args.split(' ', 1)[0])
+                with self.lock:
+                    self.messages[uid]['seen'] = True
+                wfile.write(f'* {uid} FETCH (UID {uid} FLAGS (\\Seen))\r\n'.encode())
+            elif name == 'LOGOUT':
+                wfile.write(b'* BYE logging out\r\n')
+                wfile.write(f'{tag} OK LOGOUT completed\r\n'.encode())
+                return
+            elif name not in ('LOGIN', 'NOOP'):
+                wfile.write(f'{tag} BAD unsupported command\r\n'.encode())
+                continue
+            wfile.write(f'{tag} OK {name} completed\r\n'.encode())
+
+    def _fetch_response(self, uid, items):
+        with self.lock:
+            message = self.messages[uid]
+        parts = [f'UID {uid}'.encode()]
+        if 'BODYSTRUCTURE' in items:
+            parts.append(b'BODYSTRUCTURE ' + message['structure'])
+        if 'HEADER.FIELDS' in items:
+            parts.append(b'BODY[HEADER.FIELDS (SUBJECT)] {%d}\r\n' % len(message['header']) + message['header'])
+        for section, payload in message['sections'].items():
+            if f'BODY.PEEK[{section}]' in items:
+                parts.append(f'BODY[{section}] {{{len(payload)}}}\r\n'.encode() + payload)
+        return f'* {uid} FETCH ('.encode() + b' '.join(parts) + b')\r\n'
+
+
+class SmtpStandIn:
+    """
+    Minimal in-process SMTP server that accepts any login and counts the delivered messages.
+
+    Connections are plain TCP on 127.0.0.1.
+    """
+
+    def __init__(self):
+        self.delivered = 0
+        self.lock = threading.Lock()
+        stand_in = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                stand_in._handle(self.rfile, self.wfile)
+
+        self.server = _serve(_ThreadingTCPServer(('127.0.0.1', 0), Handler))
+        self.port = self.server.server_address[1]
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handle(self, rfile, wfile):
+        wfile.write(b'220 smtp stand-in ready\r\n')
+        while True:
+            line = rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                wfile.write(b'250-smtp stand-in\r\n250 AUTH PLAIN LOGIN\r\n')
+            elif command.startswith('AUTH'):
+                wfile.write(b'235 2.7.0 Authentication successful\r\n')
+            elif command == 'DATA':
+                wfile.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                while rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                with self.lock:
+                    self.delivered += 1
+                wfile.write(b'250 2.0.0 Ok: queued\r\n')
+            elif command == 'QUIT':
+                wfile.write(b'221 2.0.0 Bye\r\n')
+                return
+            else:
+                wfile.write(b'250 2.0.0 Ok\r\n')
+
+
+class WebDavStandIn:
+    """
+    Minimal in-process WebDAV server with the subset of Nextcloud used by syn_nextcloud.py.
+
+    Files are kept in memory by path. PUT answers with an ETag and stores the OC-Checksum, PROPFIND lists
+    a folder with Depth 0 or 1, and MKCOL/MOVE support chunked uploads. Uploaded bytes are counted.
+
+    fail_hook can be set to a callable taking (method, path) to simulate server errors: when it returns an
+    HTTP status code, the request is answered with that status instead of being carried out.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.folders = set()
+        self.bytes_received = 0
+        self.fail_hook = None
+        self.lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _path(self):
+                return unquote(urlparse(self.path).path).rstrip('/')
+
+            def _reply(self, status, body=b'', headers=None):
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _body(self):
+                return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            def _failed(self):
+                status = stand_in.fail_hook(self.command, self._path()) if stand_in.fail_hook else None
+                if status is None:
+                    return False
+                self._reply(status)
+                return True
+
+            def do_PUT(self):
+                data = self._body()
+                if self._failed():
+                    return
+                etag = stand_in._store(self._path(), data, self.headers.get('OC-Checksum'))
+                self._reply(201, headers={'ETag': f'"{etag}"', 'OC-ETag': f'"{etag}"'})
+
+            def do_MKCOL(self):
+                self._body()
+                if self._failed():
+                    return
+                with stand_in.lock:
+                    stand_in.folders.add(self._path())
+                self._reply(201)
+
+            def do_MOVE(self):
+                self._body()
+                if self._failed():
+                    return
+                upload_dir = self._path().rsplit('/', 1)[0]
+                destination = unquote(urlparse(self.headers['Destination']).path)
+                with stand_in.lock:
+                    chunks = sorted(path for path in stand_in.files if path.startswith(upload_dir + '/'))
+                    data = b''.join(stand_in.files.pop(path)['data'] for path in chunks)
+                    stand_in.folders.discard(upload_dir)
+                etag = stand_in._store(destination, data, self.headers.get('OC-Checksum'), count=False)
+                self._reply(201, headers={'ETag': f'"{etag}"', 'OC-ETag': f'"{etag}"'})
+
+            def do_PROPFIND(self):
+                self._body()
+                if self._failed():
+                    return
+                body = stand_in._multistatus(self._path(), self.headers.get('Depth', '1'))
+                self._reply(207, body, {'Content-Type': 'application/xml; charset=utf-8'})
+
+        self.server = _serve(ThreadingHTTPServer(('127.0.0.1', 0), Handler))
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    def base_url(self, username):
+        """Return the NEXTCLOUD_BASE_URL for the given user."""
+        return f'http://127.0.0.1:{self.port}/remote.php/dav/files/{username}'
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _store(self, path, data, checksum, count=True):
+        etag = uuid.uuid4().hex
+        with self.lock:
+            if count:
+                self.bytes_received += len(data)
+            self.files[path] = {
+                'data': data,
+                'etag': etag,
+                'checksum': checksum or f'SHA1:{hashlib.sha1(data).hexdigest()}',
+                'modified': time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime()),
+            }
+        return etag
+
+    def _multistatus(self, folder, depth):
+        with self.lock:
+            children = {path: entry for path, entry in self.files.items() if path.rsplit('/', 1)[0] == folder}
+            # The folder's ETag changes whenever one of its files does
+            folder_etag = hashlib.md5(''.join(sorted(entry['etag'] for entry in children.values())).encode()).hexdigest()
+        responses = [
+            f'<d:response><d:href>{quote(folder)}/</d:href><d:propstat><d:prop>'
+            f'<d:getetag>"{folder_etag}"</d:getetag><d:resourcetype><d:collection/></d:resourcetype>'
+            f'</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>'
+        ]
+        if depth != '0':
+            for path, entry in children.items():
+                responses.append(
+                    f'<d:response><d:href>{quote(path)}</d:href><d:propstat><d:prop>'
+                    f'<d:getetag>"{entry["etag"]}"</d:getetag><d:getcontentlength>{len(entry["data"])}</d:getcontentlength>'
+                    f'<d:getlastmodified>{entry["modified"]}</d:getlastmodified><d:resourcetype/>'
+                    f'<oc:checksums><oc:checksum>{entry["checksum"]}</oc:checksum></oc:checksums>'
+                    f'</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>'
+                )
+        return ('<?xml version="1.0" encoding="utf-8"?>'
+                '<d:multistatus xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns">'
+                + ''.join(responses) + '</d:multistatus>').encode()
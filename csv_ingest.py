@@ -0,0 +1,86 @@
+import csv
+
+# Record attribute, CSV column header and the value used when the column is missing or the cell is empty
+FIELDS = (
+    ('name', 'Vorname und Nachname', None),
+    ('berufsbezeichnung', 'Berufsbezeichnung', 'N/A'),
+    ('abteilung', 'Abteilung', 'N/A'),
+    ('email', 'Gewünschte Dienstliche E-Mail-Adresse', 'N/A'),
+    ('vertragsbeginn', 'Vertragsbeginn', 'N/A'),
+    ('uebergabedatum', 'Gewünschtes Übergabedatum der Geräte', 'N/A'),
+    ('gruppenpostfaecher', 'Gruppenpostfächer Erforderlich?', 'N/A'),
+    ('arbeitsgeraete', 'Der Mitarbeiter Benötigt Folgende Arbeitsgeräte', ''),
+    ('zugaenge', 'Die Folgenden Zugänge und Rollen Sollen Zu Workspace Eingerichtet Werden', ''),
+    ('software', 'Darüber Hinaus Benötigt Er Folgende Software', ''),
+    ('standard_zugaenge', 'Zugänge, Die Standardmäßig Eingerichtet Werden Sollen, Bitte Benennen', ''),
+    ('standard_ressourcen', 'Ressourcen, Die Standardmäßig Eingerichtet Werden Sollen, Bitte Benennen', ''),
+    ('telefon', 'TUBS-Telefon-Direktwahl-Nr. 030 447202 (10-89)', ''),
+    ('softwarewunsch', 'Haben Sie Einen Zusätzlichen Softwarewunsch?', ''),
+    ('bemerkungen', 'Haben Wir Irgendetwas Übersehen? Schreiben Sie Uns Hier.', 'nan'),
+    ('vereinbarung', 'Vereinbarung', ''),
+    ('unterschrift', 'Unterschrift', ''),
+)
+
+
+class OnboardingRecord:
+    """One onboarding request from the HR export, with every field normalized to a string (or None for a missing name)."""
+
+    __slots__ = tuple(attribute for attribute, _, _ in FIELDS)
+
+    def __init__(self, values):
+        for (attribute, _, _), value in zip(FIELDS, values):
+            setattr(self, attribute, value)
+
+    def astuple(self):
+        """Return the field values in FIELDS order."""
+        return tuple(getattr(self, attribute) for attribute in self.__slots__)
+
+    def __repr__(self):
+        return f"OnboardingRecord(name={self.name!r})"
+
+
+def resolve_columns(header):
+    """
+    Map every record field to its column position in the CSV header.
+
+    Args:
+        header (list): The header row of the CSV file.
+
+    Returns:
+        list: (column index or None, default) per field, in FIELDS order.
+    """
+    positions = {column.strip(): index for index, column in enumerate(header)}
+    return [(positions.get(column), default) for _, column, default in FIELDS]
+
+
+def iter_csv_records(csv_file):
+    """
+    Read an onboarding CSV lazily, one record at a time.
+
+    The column mapping is resolved once from the header; every row is then turned into an OnboardingRecord.
+    Missing columns and empty cells get the field's default, so no row fails on an empty value.
+
+    Args:
+        csv_file (str): Path to the CSV file.
+
+    Yields:
+        tuple: (row index, OnboardingRecord), with the index counting data rows from 0.
+    """
+    with open(csv_file, 'r', encoding='utf-8-sig', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        columns = resolve_columns(header)
+
+        index = 0
+        for row in reader:
+            if not any(cell.strip() for cell in row):
+                # Skip blank lines
+                continue
+            values = []
+            for position, default in columns:
+                value = row[position].strip() if position is not None and position < len(row) else ''
+                values.append(value if value else default)
+            yield index, OnboardingRecord(values)
+            index += 1
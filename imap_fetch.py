@@ -0,0 +1,231 @@
+import base64
+import quopri
+import shutil
+import io
+from email.header import decode_header, make_header
+from email.utils import decode_rfc2231
+from urllib.parse import unquote
+
+# Content types that mark a part as CSV even when it carries no usable filename
+CSV_CONTENT_TYPES = {('text', 'csv'), ('application', 'csv'), ('text', 'comma-separated-values')}
+
+
+def _tokenize(data):
+    """Split a flattened IMAP response into '(', ')', strings/atoms (bytes) and None for NIL."""
+    tokens = []
+    pos = 0
+    length = len(data)
+    while pos < length:
+        char = data[pos:pos + 1]
+        if char in (b' ', b'\r', b'\n'):
+            pos += 1
+        elif char in (b'(', b')'):
+            tokens.append(char.decode())
+            pos += 1
+        elif char == b'"':
+            # Quoted string with backslash escapes
+            value = bytearray()
+            pos += 1
+            while data[pos:pos + 1] != b'"':
+                if data[pos:pos + 1] == b'\\':
+                    pos += 1
+                value += data[pos:pos + 1]
+                pos += 1
+            tokens.append(bytes(value))
+            pos += 1
+        elif char == b'{':
+            # Literal: {n}\r\n followed by exactly n bytes
+            end = data.index(b'}', pos)
+            size = int(data[pos + 1:end])
+            start = end + 3
+            tokens.append(data[start:start + size])
+            pos = start + size
+        else:
+            # Atom; a bracketed section such as BODY[HEADER.FIELDS (SUBJECT)] belongs to the atom
+            start = pos
+            depth = 0
+            while pos < length:
+                char = data[pos:pos + 1]
+                if char == b'[':
+                    depth += 1
+                elif char == b']':
+                    depth -= 1
+                elif depth == 0 and char in (b' ', b'(', b')', b'\r', b'\n'):
+                    break
+                pos += 1
+            atom = data[start:pos]
+            tokens.append(None if atom.upper() == b'NIL' else atom)
+    return tokens
+
+
+def _build(tokens, pos=0):
+    """Turn a token list into nested lists, returning (items, next_position)."""
+    items = []
+    while pos < len(tokens):
+        token = tokens[pos]
+        if token == '(':
+            child, pos = _build(tokens, pos + 1)
+            items.append(child)
+        elif token == ')':
+            return items, pos + 1
+        else:
+            items.append(token)
+            pos += 1
+    return items, pos
+
+
+def parse_fetch_response(data):
+    """
+    Parse the data returned by imaplib for a (UID) FETCH command.
+
+    Args:
+        data (list): The response data from imaplib, where literals arrive as (prefix, literal) tuples.
+
+    Returns:
+        list: One dict per message mapping upper-case item names (e.g. 'UID', 'BODYSTRUCTURE', 'BODY[2]')
+        to their parsed values.
+    """
+    chunks = []
+    for item in data:
+        if isinstance(item, tuple):
+            chunks.append(item[0] + b'\r\n' + item[1])
+        elif item:
+            chunks.append(item)
+    items, _ = _build(_tokenize(b' '.join(chunks)))
+
+    # The response is a sequence of "<msgno> (<name> <value> ...)" pairs
+    messages = []
+    for entry in items:
+        if isinstance(entry, list):
+            message = {}
+            for i in range(0, len(entry) - 1, 2):
+                name = entry[i].decode('ascii', 'replace').upper()
+                # BODY.PEEK[...] is answered as BODY[...]
+                message[name.replace('BODY.PEEK[', 'BODY[')] = entry[i + 1]
+            messages.append(message)
+    return messages
+
+
+def _text(value):
+    return value.decode('utf-8', 'replace') if isinstance(value, bytes) else value
+
+
+def _params(value):
+    """Convert an IMAP parameter list ("name" "value" ...) to a dict with lower-case names."""
+    if not isinstance(value, list):
+        return {}
+    return {_text(value[i]).lower(): _text(value[i + 1]) for i in range(0, len(value) - 1, 2)}
+
+
+def _decode_filename(params):
+    filename = params.get('filename') or params.get('name')
+    if filename is None:
+        encoded = params.get('filename*') or params.get('name*')
+        if encoded is None:
+            return None
+        # RFC 2231 form: charset'language'percent-encoded-value
+        parts = decode_rfc2231(encoded)
+        if isinstance(parts, list):
+            charset, _, encoded = parts
+        else:
+            charset = None
+        return unquote(encoded, encoding=charset or 'utf-8', errors='replace')
+    try:
+        # Encoded words such as =?utf-8?q?Mitarbeiter=C3=BC.csv?=
+        return str(make_header(decode_header(filename)))
+    except Exception:
+        return filename
+
+
+def iter_body_parts(structure, section=''):
+    """
+    Walk a parsed BODYSTRUCTURE and yield every non-multipart part with its IMAP section number.
+
+    Parts of attached messages (message/rfc822) are included, so CSV files inside forwarded mails are found.
+
+    Args:
+        structure (list): The parsed BODYSTRUCTURE value.
+        section (str): Section number of the structure itself; empty for the top-level message.
+
+    Yields:
+        dict: section, type, subtype, encoding, size, disposition and filename of each part.
+    """
+    if isinstance(structure[0], list):
+        # Multipart: children first, then the subtype and extension data
+        for number, child in enumerate(structure, 1):
+            if not isinstance(child, list):
+                break
+            yield from iter_body_parts(child, f'{section}.{number}' if section else str(number))
+        return
+
+    part_section = section or '1'
+    main_type = _text(structure[0]).lower()
+    subtype = _text(structure[1]).lower()
+    content_params = _params(structure[2])
+
+    # Extension fields follow the basic fields; text and message/rfc822 parts carry extra fields before them
+    if main_type == 'text':
+        disposition_index = 9
+    elif (main_type, subtype) == ('message', 'rfc822'):
+        disposition_index = 11
+    else:
+        disposition_index = 8
+    disposition = structure[disposition_index] if len(structure) > disposition_index else None
+    disposition_type = None
+    disposition_params = {}
+    if isinstance(disposition, list) and disposition:
+        disposition_type = _text(disposition[0]).lower()
+        disposition_params = _params(disposition[1] if len(disposition) > 1 else None)
+
+    yield {
+        'section': part_section,
+        'type': main_type,
+        'subtype': subtype,
+        'encoding': (_text(structure[5]) or '7bit').lower(),
+        'size': int(structure[6]) if structure[6] is not None else 0,
+        'disposition': disposition_type,
+        'filename': _decode_filename(disposition_params) or _decode_filename(content_params),
+    }
+
+    if (main_type, subtype) == ('message', 'rfc822') and len(structure) > 8 and isinstance(structure[8], list):
+        inner = structure[8]
+        # An encapsulated multipart numbers its children <section>.1, <section>.2, ...; a single body is <section>.1
+        yield from iter_body_parts(inner, part_section if isinstance(inner[0], list) else f'{part_section}.1')
+
+
+def find_csv_parts(structure):
+    """
+    Return the parts of a message that are CSV attachments.
+
+    A part counts as CSV when its filename ends with .csv or its content type is a CSV type.
+
+    Args:
+        structure (list): The parsed BODYSTRUCTURE value.
+
+    Returns:
+        list: The matching part dicts from iter_body_parts.
+    """
+    csv_parts = []
+    for part in iter_body_parts(structure):
+        filename = part['filename']
+        if (filename and filename.lower().endswith('.csv')) or (part['type'], part['subtype']) in CSV_CONTENT_TYPES:
+            csv_parts.append(part)
+    return csv_parts
+
+
+def decode_part_to_file(payload, encoding, output_file):
+    """
+    Decode a fetched MIME section according to its transfer encoding and stream it into a file.
+
+    Args:
+        payload (bytes): The raw section as returned by BODY[<section>].
+        encoding (str): The Content-Transfer-Encoding from BODYSTRUCTURE.
+        output_file (file): Binary file object to write the decoded data to.
+    """
+    source = io.BytesIO(payload)
+    if encoding == 'base64':
+        base64.decode(source, output_file)
+    elif encoding == 'quoted-printable':
+        quopri.decode(source, output_file)
+    else:
+        shutil.copyfileobj(source, output_file)
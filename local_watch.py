@@ -0,0 +1,193 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def _load_inotify():
+    """Return libc with the inotify functions, or None when inotify is not available (e.g. not on Linux)."""
+    if not hasattr(os, 'uname') or os.uname().sysname != 'Linux':
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+def _ignored(name):
+    # Hidden and temporary files are written by other tools and renamed into place when finished
+    return name.startswith('.') or name.endswith('.tmp')
+
+
+class LocalChangeWatcher:
+    """
+    Report files that were created or modified in a set of local folders.
+
+    Uses Linux inotify when available and falls back to comparing os.scandir snapshots otherwise. The fallback
+    is chosen per folder, so a folder that cannot be watched (e.g. because it does not exist yet) is scanned
+    while the other folders keep their inotify watches.
+    A change is only reported once the file has settled: with inotify after it was closed for writing
+    (or moved into place) and no further events arrived for `debounce` seconds; with scanning once its
+    size and mtime stayed the same for `debounce` seconds. Files that are written without ever being
+    closed are reported after `settle_timeout` seconds of silence.
+
+    Args:
+        folders (list): The local folders to watch.
+        debounce (float): Seconds a file must stay quiet before it is reported.
+        poll_interval (float): Seconds between scans in the scandir fallback.
+        settle_timeout (float): Seconds of silence after which a file that was never closed is reported anyway.
+    """
+
+    def __init__(self, folders, debounce=1.0, poll_interval=2.0, settle_timeout=30.0):
+        self.folders = [os.path.abspath(folder) for folder in folders]
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.settle_timeout = settle_timeout
+        # (folder, name) -> [time of last event, closed for writing]
+        self.pending = {}
+        self.fd = None
+        self.watches = {}
+
+        libc = _load_inotify()
+        if libc is not None:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                for folder in self.folders:
+                    wd = libc.inotify_add_watch(fd, os.fsencode(folder), WATCH_MASK)
+                    if wd >= 0:
+                        self.watches[wd] = folder
+                if self.watches:
+                    self.fd = fd
+                else:
+                    os.close(fd)
+
+        # Folders without an inotify watch are compared against os.scandir snapshots instead
+        watched = set(self.watches.values())
+        self.scanned = [folder for folder in self.folders if folder not in watched]
+        self.snapshots = {folder: self._scan(folder) for folder in self.scanned}
+
+    @property
+    def mode(self):
+        """Return 'inotify', 'scandir' or 'inotify+scandir', depending on how changes are detected."""
+        if self.fd is None:
+            return 'scandir'
+        return 'inotify+scandir' if self.scanned else 'inotify'
+
+    def close(self):
+        """Release the inotify file descriptor."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def poll(self, timeout):
+        """
+        Wait up to `timeout` seconds for changes and return the files that have settled.
+
+        Args:
+            timeout (float): Maximum number of seconds to wait.
+
+        Returns:
+            list: (folder, file name) tuples of settled files, in the order they changed.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if self.fd is not None:
+                # Wake up early when a pending file is due to settle or the scanned folders are due
+                wait = remaining if not self.pending else min(remaining, self.debounce)
+                if self.scanned:
+                    wait = min(wait, self.poll_interval)
+                self._read_events(max(0.0, wait))
+            if self.scanned:
+                self._scan_changes()
+
+            ready = self._take_settled()
+            if ready or time.monotonic() >= deadline:
+                return ready
+            if self.fd is None:
+                time.sleep(max(0.0, min(self.poll_interval, deadline - time.monotonic())))
+
+    def _read_events(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        now = time.monotonic()
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_length].rstrip(b'\0'))
+            offset += name_length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost; treat every file in the watched folders as changed
+                for folder in self.folders:
+                    for entry_name in self._scan(folder):
+                        self.pending[(folder, entry_name)] = [now, True]
+                continue
+            folder = self.watches.get(wd)
+            if folder is None or not name or mask & IN_ISDIR or _ignored(name):
+                continue
+
+            state = self.pending.setdefault((folder, name), [now, False])
+            state[0] = now
+            state[1] = bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO))
+
+    @staticmethod
+    def _scan(folder):
+        snapshot = {}
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_file() and not _ignored(entry.name):
+                        stat = entry.stat()
+                        snapshot[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            pass
+        return snapshot
+
+    def _scan_changes(self):
+        now = time.monotonic()
+        for folder in self.scanned:
+            snapshot = self._scan(folder)
+            previous = self.snapshots.get(folder, {})
+            for name, signature in snapshot.items():
+                if previous.get(name) != signature:
+                    # Size or mtime moved since the last scan, so the file may still be written
+                    self.pending[(folder, name)] = [now, True]
+            self.snapshots[folder] = snapshot
+
+    def _take_settled(self):
+        now = time.monotonic()
+        ready = []
+        for key, (last_event, closed) in list(self.pending.items()):
+            quiet = now - last_event
+            if (closed and quiet >= self.debounce) or quiet >= self.settle_timeout:
+                del self.pending[key]
+                if os.path.isfile(os.path.join(*key)):
+                    ready.append((last_event, key))
+        ready.sort()
+        return [key for _, key in ready]
@@ -0,0 +1,215 @@
+import logging
+import smtplib
+import socket
+import threading
+import time
+import queue
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SMTP_SEND_SECONDS = metrics.timer('onboarding_smtp_send_seconds', 'Duration of delivering one email, including reconnects.')
+EMAILS_TOTAL = metrics.counter('onboarding_emails_total', 'Emails handled by the outbox, by result.', ('result',))
+OUTBOX_PENDING = metrics.gauge('onboarding_outbox_pending', 'Emails queued, being sent or waiting for a retry.')
+
+# Errors that mean the connection itself is gone. SMTPException subclasses OSError, so catching OSError would also
+# catch the server's replies, such as a 550 rejection, which must go straight to the retry logic instead
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout)
+
+
+class TokenBucket:
+    """
+    Simple token bucket used to throttle outgoing mail.
+
+    Args:
+        rate (float): Tokens added per second.
+        capacity (int): Maximum number of tokens, i.e. the largest burst allowed.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SmtpOutbox:
+    """
+    Outbound mail queue with a background sender thread.
+
+    The sender keeps one authenticated SMTP_SSL connection open and reuses it for every message,
+    reconnects when the server drops it, closes it after it has been idle for a while and throttles
+    sending with a token bucket. Failed sends are retried with exponential backoff instead of being dropped.
+
+    Args:
+        host (str): SMTP server host name.
+        port (int): SMTP server port (SSL).
+        username (str): Login name for the SMTP server.
+        password (str): Password for the SMTP server.
+        rate (float): Maximum sustained number of messages per second.
+        burst (int): Number of messages that may be sent back to back before throttling applies.
+        max_retries (int): Number of retries for a failed message before it is given up.
+        retry_backoff (float): Delay in seconds before the first retry; doubled for every further retry.
+        idle_timeout (float): Seconds without messages after which the SMTP connection is closed.
+        use_ssl (bool): Connect with SMTP_SSL; plain SMTP is only meant for local test servers.
+
+    Raises:
+        ValueError: If rate is not a positive number.
+    """
+
+    def __init__(self, host, port, username, password, rate=0.5, burst=5, max_retries=5, retry_backoff=10, idle_timeout=60,
+                 use_ssl=True):
+        if not rate > 0:
+            raise ValueError(f"SMTP send rate must be greater than 0, got {rate}")
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.idle_timeout = idle_timeout
+        self.use_ssl = use_ssl
+        self.bucket = TokenBucket(rate, burst)
+        self.queue = queue.Queue()
+        self.server = None
+        self.thread = None
+        # Number of messages that are queued, being sent or waiting for a retry
+        self.pending = 0
+        self.pending_changed = threading.Condition()
+
+    def start(self):
+        """Start the background sender thread."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='smtp-outbox', daemon=True)
+            self.thread.start()
+            OUTBOX_PENDING.set_function(lambda: self.pending)
+        return self
+
+    def send(self, msg):
+        """
+        Queue a message for delivery and return immediately.
+
+        Args:
+            msg (email.message.Message): The message to send.
+        """
+        with self.pending_changed:
+            self.pending += 1
+        self.queue.put((msg, 0))
+        logger.debug(f"Email to {msg['To']} queued ({self.queue.qsize()} waiting)")
+
+    def flush(self, timeout=None):
+        """
+        Wait until every queued message has been delivered or given up.
+
+        Args:
+            timeout (float): Maximum number of seconds to wait, or None to wait indefinitely.
+
+        Returns:
+            bool: True if the queue was drained, False if the timeout expired first.
+        """
+        with self.pending_changed:
+            return self.pending_changed.wait_for(lambda: self.pending == 0, timeout)
+
+    def _finish(self):
+        with self.pending_changed:
+            self.pending -= 1
+            self.pending_changed.notify_all()
+
+    def _run(self):
+        while True:
+            try:
+                msg, attempt = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                try:
+                    self._disconnect()
+                except Exception as e:
+                    logger.warning(f"Error closing idle SMTP connection: {e}")
+                continue
+
+            try:
+                self._send(msg, attempt)
+            except Exception as e:
+                # An unexpected error must not end the sender thread, which would leave flush() waiting forever
+                EMAILS_TOTAL.inc(result='failed')
+                logger.exception(f"Unexpected error in the SMTP outbox, dropping email to {msg['To']}: {e}")
+                self._finish()
+
+    def _send(self, msg, attempt):
+        self.bucket.acquire()
+        try:
+            with SMTP_SEND_SECONDS.time():
+                self._deliver(msg)
+        except Exception as e:
+            self._retry_or_drop(msg, attempt, e)
+            return
+        EMAILS_TOTAL.inc(result='sent')
+        logger.info(f"Email sent to {msg['To']}")
+        self._finish()
+
+    def _retry_or_drop(self, msg, attempt, error):
+        # Permanent (5xx) rejections will not succeed on a retry
+        permanent = isinstance(error, smtplib.SMTPRecipientsRefused) or (
+            isinstance(error, smtplib.SMTPResponseException) and 500 <= error.smtp_code < 600)
+        if permanent or attempt >= self.max_retries:
+            EMAILS_TOTAL.inc(result='failed')
+            logger.error(f"Failed to send email to {msg['To']}, giving up after {attempt + 1} attempts: {error}")
+            self._finish()
+            return
+
+        delay = self.retry_backoff * (2 ** attempt)
+        EMAILS_TOTAL.inc(result='retried')
+        logger.warning(f"Failed to send email to {msg['To']}: {error}. Retrying in {delay} seconds...")
+        timer = threading.Timer(delay, self.queue.put, args=((msg, attempt + 1),))
+        timer.daemon = True
+        timer.start()
+
+    def _connect(self):
+        logger.debug(f"Attempting to connect to SMTP server {self.host} on port {self.port}{' using SSL' if self.use_ssl else ''}...")
+        server = smtplib.SMTP_SSL(self.host, self.port) if self.use_ssl else smtplib.SMTP(self.host, self.port)
+        try:
+            server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        logger.info(f"Connected and logged in to SMTP server {self.host}")
+        self.server = server
+
+    def _disconnect(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                self.server.close()
+            self.server = None
+
+    def _deliver(self, msg):
+        if self.server is None:
+            self._connect()
+        try:
+            self.server.send_message(msg)
+        except CONNECTION_ERRORS:
+            # The kept-open connection went stale; reconnect once and resend on a fresh connection
+            self.server.close()
+            self.server = None
+            self._connect()
+            try:
+                self.server.send_message(msg)
+            except CONNECTION_ERRORS:
+                self.server.close()
+                self.server = None
+                raise
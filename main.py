@@ -1,54 +1,134 @@
+import argparse
 import imaplib
 import email
+import logging
 import os
-import pandas as pd
-import pdfkit
-from jinja2 import Template
-from PyPDF2 import PdfWriter, PdfReader, PageObject
+import shutil
+import sys
 from datetime import datetime
-from email.header import decode_header
+from email.header import decode_header, make_header
 import time
 from pathlib import Path
 from dotenv import load_dotenv
 import uuid
-import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import re
+import socket
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
+from mail_queue import SmtpOutbox
+from imap_fetch import parse_fetch_response, find_csv_parts, decode_part_to_file
+from csv_ingest import iter_csv_records
+from processing_ledger import ProcessingLedger, file_sha256, record_key, record_fingerprint
+import metrics
 
 # Load environment variables from .env file
 load_dotenv(dotenv_path=Path(__file__).parent / 'env' / '.env')
 
+logger = logging.getLogger(__name__)
+
+# Timers and counters for every stage, exposed by the metrics endpoint
+IMAP_FETCH_SECONDS = metrics.timer('onboarding_imap_fetch_seconds', 'Duration of IMAP FETCH commands.', ('item',))
+CSV_PARSE_SECONDS = metrics.timer('onboarding_csv_parse_seconds', 'Time spent reading and normalizing one CSV row.')
+TEMPLATE_RENDER_SECONDS = metrics.timer('onboarding_template_render_seconds', 'Duration of Jinja template renders.', ('template',))
+WKHTMLTOPDF_SECONDS = metrics.timer('onboarding_wkhtmltopdf_seconds', 'Duration of wkhtmltopdf conversions.')
+OVERLAY_SECONDS = metrics.timer('onboarding_overlay_seconds', 'Duration of overlaying one letter onto the letterhead.')
+ROWS_TOTAL = metrics.counter('onboarding_rows_total', 'CSV rows processed, by result.', ('result',))
+ERRORS_TOTAL = metrics.counter('onboarding_errors_total', 'Errors, by stage.', ('stage',))
+
 # Load the sync interval from the environment or set a default (in seconds)
 SYNC_INTERVAL = int(os.getenv('SYNC_INTERVAL', 60))  # Default is 60 seconds
 
+# Number of rows rendered in parallel; this also caps the number of concurrent wkhtmltopdf processes
+RENDER_WORKERS = max(1, int(os.getenv('RENDER_WORKERS', 4)))
+# Worker pool type used for rendering: 'thread' or 'process'
+RENDER_POOL = os.getenv('RENDER_POOL', 'thread').strip().lower()
+# 'batch' renders several rows with one wkhtmltopdf call and splits the result per person, 'row' renders each row on its own
+RENDER_MODE = os.getenv('RENDER_MODE', 'batch').strip().lower()
+# Maximum number of rows rendered by a single wkhtmltopdf call in batch mode
+RENDER_BATCH_SIZE = max(1, int(os.getenv('RENDER_BATCH_SIZE', 50)))
 
 # Retrieve secret credentials and directories from environment variables
 IMAP_SERVER = os.getenv('IMAP_SERVER')
 SMTP_SERVER = os.getenv('SMTP_SERVER')
-EMAIL_PORT = int(os.getenv('EMAIL_PORT'))
+EMAIL_PORT = int(os.getenv('EMAIL_PORT', 465))
 EMAIL_ACCOUNT = os.getenv('EMAIL_ACCOUNT')
 PASSWORD = os.getenv('PASSWORD')
 MAILBOX = os.getenv('MAILBOX')
+# IMAP over SSL (port 993) by default; plain connections are only meant for local test servers
+IMAP_SSL = os.getenv('IMAP_SSL', 'true').strip().lower() in ('1', 'true', 'yes')
+IMAP_PORT = int(os.getenv('IMAP_PORT', 993 if IMAP_SSL else 143))
+SMTP_SSL = os.getenv('SMTP_SSL', 'true').strip().lower() in ('1', 'true', 'yes')
+
+# Long-running IMAP session: use IDLE when available, otherwise poll every SYNC_INTERVAL seconds
+IMAP_IDLE = os.getenv('IMAP_IDLE', 'true').strip().lower() in ('1', 'true', 'yes')
+IMAP_IDLE_TIMEOUT = int(os.getenv('IMAP_IDLE_TIMEOUT', 300))  # Re-issue IDLE after this many seconds (servers drop it after 30 min)
+IMAP_RESPONSE_TIMEOUT = 30  # Seconds to wait for the server to answer IDLE/DONE
+IMAP_RECONNECT_DELAY = 5  # First reconnect delay in seconds, doubled up to IMAP_MAX_RECONNECT_DELAY
+IMAP_MAX_RECONNECT_DELAY = 300
+
+# Outbound mail throttling and retries
+SMTP_RATE = float(os.getenv('SMTP_RATE', 0.5))  # Messages per second
+SMTP_BURST = int(os.getenv('SMTP_BURST', 5))
+SMTP_MAX_RETRIES = int(os.getenv('SMTP_MAX_RETRIES', 5))
+SMTP_RETRY_BACKOFF = float(os.getenv('SMTP_RETRY_BACKOFF', 10))  # Seconds before the first retry, doubled per retry
+SMTP_IDLE_TIMEOUT = float(os.getenv('SMTP_IDLE_TIMEOUT', 60))  # Close the SMTP connection after this many idle seconds
 
 # Recipients from .env file
 MINUTH_EMAIL = os.getenv('MINUTH_EMAIL')
 DRITICH_EMAIL = os.getenv('DRITICH_EMAIL')
 
-# Retrieve directory paths from environment variables
-TEMPLATES_DIR = Path(os.getenv('TEMPLATES_DIR'))
-ATTACHMENTS_DIR = Path(os.getenv('ATTACHMENTS_DIR'))
-ONBOARDED_DIR = Path(os.getenv('ONBOARDED_DIR'))
-TEMP_PDF_DIR = Path(os.getenv('TEMP_PDF_DIR'))
-EMAIL_TEXT_DIR = Path(os.getenv('EMAIL_TEXT_DIR'))
+# Retrieve directory paths from environment variables; output directories are created when first written to
+TEMPLATES_DIR = Path(os.getenv('TEMPLATES_DIR', 'templates'))
+ATTACHMENTS_DIR = Path(os.getenv('ATTACHMENTS_DIR', 'attachments'))
+ONBOARDED_DIR = Path(os.getenv('ONBOARDED_DIR', 'onboarded_person'))
+EMAIL_TEXT_DIR = Path(os.getenv('EMAIL_TEXT_DIR', 'email_text'))
+TEMPLATE_CACHE_DIR = Path(os.getenv('TEMPLATE_CACHE_DIR', 'template_cache'))
+
+# Ledger of already processed attachments (by content hash) and rows (by fingerprint)
+LEDGER_FILE = os.getenv('LEDGER_FILE', 'processing_ledger.json')
+
+# wkhtmltopdf executable; looked up on PATH when not set
+WKHTMLTOPDF_PATH = os.getenv('WKHTMLTOPDF_PATH') or shutil.which('wkhtmltopdf')
+
+LETTER_TEMPLATE = 'onboarding_template.html'
+
+# jinja2, pdfkit and PyPDF2 are only imported by the functions that use them, so commands that
+# never render (sync, poll without new mail, --help) start without loading them
+template_env = None
+_template_env_lock = threading.Lock()
+
+# Shared Jinja environment for the letter and the notification emails, created on first use.
+# Templates are compiled once and kept in memory; auto_reload recompiles a template when its file's mtime changes,
+# and the bytecode cache keeps the compiled code across restarts.
+def get_template_env():
+    global template_env
+    with _template_env_lock:
+        if template_env is None:
+            from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+            TEMPLATE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            template_env = Environment(
+                loader=FileSystemLoader([str(TEMPLATES_DIR), str(EMAIL_TEXT_DIR)]),
+                auto_reload=True,
+                bytecode_cache=FileSystemBytecodeCache(str(TEMPLATE_CACHE_DIR)),
+            )
+        return template_env
+
+# pdfkit configuration for the wkhtmltopdf executable, created on first use
+pdfkit_config = None
+
+def get_pdfkit_config():
+    global pdfkit_config
+    if pdfkit_config is None:
+        import pdfkit
+        if not WKHTMLTOPDF_PATH:
+            raise RuntimeError("wkhtmltopdf was not found; install it or set WKHTMLTOPDF_PATH")
+        pdfkit_config = pdfkit.configuration(wkhtmltopdf=WKHTMLTOPDF_PATH)
+    return pdfkit_config
 
-# Ensure directories exist
-for directory in [ATTACHMENTS_DIR, TEMPLATES_DIR, ONBOARDED_DIR, TEMP_PDF_DIR, EMAIL_TEXT_DIR]:
-    directory.mkdir(parents=True, exist_ok=True)
-
-# Configure path to wkhtmltopdf
-path_to_wkhtmltopdf = Path(r'C:\Program Files\wkhtmltopdf\bin\wkhtmltopdf.exe')
-config = pdfkit.configuration(wkhtmltopdf=str(path_to_wkhtmltopdf))
 options = {
     'enable-local-file-access': None,
     'page-size': 'A4',
@@ -58,16 +138,39 @@ options = {
     'margin-right': '20mm'
 }
 
+# Outbound mail queue, started on first use so render worker processes never open SMTP connections
+mail_outbox = None
+_mail_outbox_lock = threading.Lock()
+
+def get_mail_outbox():
+    global mail_outbox
+    with _mail_outbox_lock:
+        if mail_outbox is None:
+            mail_outbox = SmtpOutbox(
+                SMTP_SERVER, EMAIL_PORT, EMAIL_ACCOUNT, PASSWORD,
+                rate=SMTP_RATE, burst=SMTP_BURST, max_retries=SMTP_MAX_RETRIES,
+                retry_backoff=SMTP_RETRY_BACKOFF, idle_timeout=SMTP_IDLE_TIMEOUT, use_ssl=SMTP_SSL,
+            ).start()
+        return mail_outbox
+
+# Ledger of processed attachments and rows, loaded on first use
+processing_ledger = None
+_processing_ledger_lock = threading.Lock()
+
+def get_processing_ledger():
+    global processing_ledger
+    with _processing_ledger_lock:
+        if processing_ledger is None:
+            processing_ledger = ProcessingLedger(LEDGER_FILE)
+        return processing_ledger
+
 # Function to send an email with dynamic content
-def send_email_notification(to_email, subject, template_file, context):
+# The message is handed to the outbound queue, so the caller never waits on mail delivery
+def send_email_notification(to_email, subject, template_name, context):
     try:
-        # Load the email content from the text file and render the template
-        with open(template_file, 'r', encoding='utf-8') as file:
-            template_content = file.read()
-
-        # Render the email content with the context (employee data)
-        template = Template(template_content)
-        rendered_content = template.render(context)
+        # Render the cached email template (from EMAIL_TEXT_DIR) with the context (employee data)
+        with TEMPLATE_RENDER_SECONDS.time(template=template_name):
+            rendered_content = get_template_env().get_template(template_name).render(context)
 
         msg = MIMEMultipart()
         msg['From'] = EMAIL_ACCOUNT
@@ -77,19 +180,11 @@ def send_email_notification(to_email, subject, template_file, context):
         # Attach the rendered email body
         msg.attach(MIMEText(rendered_content, 'plain'))
 
-        # Send the email via SMTP over SSL
-        print(f"Attempting to connect to SMTP server {SMTP_SERVER} on port {EMAIL_PORT} using SSL...")
-        with smtplib.SMTP_SSL(SMTP_SERVER, EMAIL_PORT) as server:
-            print(f"Connected to SMTP server {SMTP_SERVER}, attempting to login...")
-            server.login(EMAIL_ACCOUNT, PASSWORD)
-            print(f"Logged in successfully, sending email to {to_email}...")
-            server.send_message(msg)
-            print(f"Email sent to {to_email}")
+        # Queue the email; the background sender delivers it via SMTP over SSL
+        get_mail_outbox().send(msg)
     except Exception as e:
-        print(f"Failed to send email to {to_email}: {e}")
-    finally:
-        # Introduce a small delay between emails to avoid potential throttling issues
-        time.sleep(5)
+        ERRORS_TOTAL.inc(stage='notify')
+        logger.error(f"Failed to queue email to {to_email}: {e}")
 
 # Helper function to split a list into chunks of a specified size and format it in title case
 def chunk_list(data_list, chunk_size=4):
@@ -97,184 +192,801 @@ def chunk_list(data_list, chunk_size=4):
     for i in range(0, len(title_case_list), chunk_size):
         yield title_case_list[i:i + chunk_size]
 
-# Function to generate PDF from HTML
-def generate_pdf_from_html(html_content, output_pdf):
+# Function to generate PDF from HTML; the PDF is returned as bytes and never written to disk
+def generate_pdf_from_html(html_content):
     try:
-        pdfkit.from_string(html_content, output_pdf, configuration=config, options=options)
-        print(f"Generated PDF: {output_pdf}")
+        import pdfkit
+        config = get_pdfkit_config()
+        with WKHTMLTOPDF_SECONDS.time():
+            pdf_bytes = pdfkit.from_string(html_content, False, configuration=config, options=options)
+        logger.debug(f"Generated PDF ({len(pdf_bytes)} bytes)")
+        return pdf_bytes
     except Exception as e:
-        print(f"Error generating PDF {output_pdf}: {e}")
-
-# Overlay generated PDF content onto the letterhead
+        ERRORS_TOTAL.inc(stage='wkhtmltopdf')
+        logger.error(f"Error generating PDF: {e}")
+    return None
+
+# Parsed letterhead pages, kept per process and keyed by path; an entry is replaced when the file's mtime changes
+_letterhead_cache = {}
+_letterhead_lock = threading.Lock()
+
+# Return the parsed first page of the letterhead, parsing the file only once per process
+def load_letterhead_page(letterhead_pdf):
+    from PyPDF2 import PdfReader
+    letterhead_pdf = str(letterhead_pdf)
+    mtime = os.path.getmtime(letterhead_pdf)
+    with _letterhead_lock:
+        cached = _letterhead_cache.get(letterhead_pdf)
+        if cached is None or cached[0] != mtime:
+            logger.info(f"Loading letterhead: {letterhead_pdf}")
+            cached = (mtime, PdfReader(letterhead_pdf).pages[0])
+            _letterhead_cache[letterhead_pdf] = cached
+        return cached[1]
+
+# Overlay generated PDF content (a path or the raw PDF bytes) onto the letterhead
 def overlay_content_on_letterhead(content_pdf, letterhead_pdf, output_pdf):
     try:
-        letterhead_reader = PdfReader(letterhead_pdf)
+        from PyPDF2 import PdfReader
+        if isinstance(content_pdf, bytes):
+            content_pdf = io.BytesIO(content_pdf)
         content_reader = PdfReader(content_pdf)
-
+        return overlay_pages_on_letterhead(content_reader.pages, letterhead_pdf, output_pdf)
+    except Exception as e:
+        logger.error(f"Error overlaying content on letterhead: {e}")
+    return False
+
+# Name under which the pages' resources refer to the letterhead Form XObject
+LETTERHEAD_XOBJECT = '/LH'
+
+# Copy the letterhead page into the writer as a Form XObject; its content stream and resources are then stored
+# once per file, and every page only refers to it
+def add_letterhead_xobject(writer, letterhead_page):
+    from PyPDF2.generic import DecodedStreamObject, NameObject, RectangleObject
+    content = DecodedStreamObject()
+    # The shared reader is not thread-safe, hence the lock while its objects are read and copied into the writer
+    with _letterhead_lock:
+        streams = letterhead_page['/Contents'] if '/Contents' in letterhead_page else []
+        if not isinstance(streams, list):
+            streams = [streams]
+        content.set_data(b'\n'.join(stream.get_object().get_data() for stream in streams))
+        resources = letterhead_page['/Resources'].clone(writer) if '/Resources' in letterhead_page else None
+        bbox = RectangleObject(letterhead_page.mediabox)
+    # flate_encode returns a new stream that only keeps the filter, so the form entries are set afterwards
+    form = content.flate_encode()
+    form[NameObject('/Type')] = NameObject('/XObject')
+    form[NameObject('/Subtype')] = NameObject('/Form')
+    form[NameObject('/BBox')] = bbox
+    if resources is not None:
+        form[NameObject('/Resources')] = resources
+    return writer._add_object(form), bbox
+
+# Make a page draw the letterhead Form XObject before its own content
+def draw_letterhead_under(page, letterhead_xobject, draw_stream, bbox):
+    from PyPDF2.generic import ArrayObject, DictionaryObject, NameObject
+    if '/Resources' not in page:
+        page[NameObject('/Resources')] = DictionaryObject()
+    resources = page['/Resources']
+    if '/XObject' not in resources:
+        resources[NameObject('/XObject')] = DictionaryObject()
+    xobjects = resources['/XObject']
+    if xobjects.get(LETTERHEAD_XOBJECT) not in (None, letterhead_xobject):
+        raise ValueError(f"Content page already uses the XObject name {LETTERHEAD_XOBJECT}")
+    xobjects[NameObject(LETTERHEAD_XOBJECT)] = letterhead_xobject
+
+    contents = page['/Contents'] if '/Contents' in page else None
+    if contents is None:
+        streams = []
+    elif isinstance(contents, ArrayObject):
+        streams = list(contents)
+    else:
+        streams = [page.raw_get('/Contents')]
+    page[NameObject('/Contents')] = ArrayObject([draw_stream] + streams)
+    page.mediabox = bbox
+
+# Overlay a sequence of content pages onto the letterhead and save them as one PDF
+def overlay_pages_on_letterhead(content_pages, letterhead_pdf, output_pdf):
+    start = time.perf_counter()
+    temp_pdf = f"{output_pdf}.tmp"
+    try:
+        from PyPDF2 import PdfWriter
+        from PyPDF2.generic import DecodedStreamObject
+        letterhead_page = load_letterhead_page(letterhead_pdf)
         writer = PdfWriter()
-        letterhead_page = letterhead_reader.pages[0]
-
-        for page_num in range(len(content_reader.pages)):
-            content_page = content_reader.pages[page_num]
-            overlay_page = PageObject.create_blank_page(width=letterhead_page.mediabox.width, height=letterhead_page.mediabox.height)
-            overlay_page.merge_page(letterhead_page)
-            overlay_page.merge_page(content_page)
-            writer.add_page(overlay_page)
-
-        with open(output_pdf, 'wb') as output_file:
+        letterhead_xobject, bbox = add_letterhead_xobject(writer, letterhead_page)
+        # One short stream, shared by all pages, that draws the letterhead with the graphics state saved around it
+        draw_stream = DecodedStreamObject()
+        draw_stream.set_data(f'q {LETTERHEAD_XOBJECT} Do Q\n'.encode())
+        draw_stream = writer._add_object(draw_stream)
+
+        for content_page in content_pages:
+            page = writer.add_page(content_page)
+            draw_letterhead_under(page, letterhead_xobject, draw_stream, bbox)
+
+        # Written under a temporary name and renamed into place, so the sync never sees a half-written letter
+        with open(temp_pdf, 'wb') as output_file:
             writer.write(output_file)
-        print(f"Final PDF saved to: {output_pdf}")
+        os.replace(temp_pdf, output_pdf)
+        logger.debug(f"Final PDF saved to: {output_pdf}")
+        OVERLAY_SECONDS.observe(time.perf_counter() - start)
+        return True
 
     except Exception as e:
-        print(f"Error overlaying content on letterhead: {e}")
-
-# Function to process CSV and generate PDF with email feature
-def process_csv_and_generate_pdf(csv_file):
-    try:
-        print(f"Processing CSV file: {csv_file}")
-
-        # Load CSV data
-        data = pd.read_csv(csv_file)
-        print(f"CSV Data loaded successfully for {csv_file}")
-
-        # Load the HTML template from the templates directory
-        with open(TEMPLATES_DIR / 'onboarding_template.html', 'r', encoding='utf-8') as file:
-            html_template = file.read()
-        print("HTML template loaded successfully")
-
-        for index, row in data.iterrows():
+        ERRORS_TOTAL.inc(stage='overlay')
+        logger.error(f"Error overlaying content on letterhead: {e}")
+        if os.path.exists(temp_pdf):
+            os.remove(temp_pdf)
+    return False
+
+# Build the template context for one onboarding record
+def build_row_context(record):
+    if not record.name:
+        raise ValueError("Missing 'Vorname und Nachname'")
+
+    # Split "Vorname und Nachname" into first and last name
+    name_parts = record.name.split()
+    vorname = name_parts[0]
+    nachname = " ".join(name_parts[1:])
+
+    # Chunk the multiline fields into formatted lists
+    arbeitsegeraete_list = list(chunk_list(record.arbeitsgeraete.split('\n')))
+    zugaenge_list = list(chunk_list(record.zugaenge.split('\n')))
+    software_list = list(chunk_list(record.software.split('\n')))
+    account_list = list(chunk_list(record.standard_zugaenge.split('\n')))
+    printer_list = list(chunk_list(record.standard_ressourcen.split('\n')))
+    # The template renders the phone numbers as table rows like the other lists
+    telephone_list = list(chunk_list(record.telefon.split('\n')))
+
+    # Prepare the context with employee data
+    return {
+        'VORNAME': vorname,
+        'NACHNAME': nachname,
+        'BERUFSBEZEICHNUNG': record.berufsbezeichnung,
+        'ABTEILUNG': record.abteilung,
+        'EMAIL': record.email,
+        'VERTRAGSBEGINN': record.vertragsbeginn,
+        'UEBERGABEDATUM': record.uebergabedatum,
+        'GRUPPENPOSTFAECHER_ERFORDERLICH': record.gruppenpostfaecher,
+        'ZUGAENGE_LIST': zugaenge_list,
+        'ARBEITSGERÄTE_LIST': arbeitsegeraete_list,
+        'SOFTWARE_LIST': software_list,
+        'ACCOUNT_LIST': account_list,  # Pass Standard-Zugänge data
+        'STANDARD_ZUGAENGE': record.standard_zugaenge,
+        'SOFTWAREWUNSCH': record.softwarewunsch,
+        'STANDARD_RESSOURCEN': printer_list,
+        'TELEFONNUMMER': telephone_list,
+        'BEMERKUNGEN': record.bemerkungen,
+        'VEREINBARUNG': record.vereinbarung,
+        'UNTERSCHRIFT': record.unterschrift,
+    }
+
+# Output path of the final onboarding letter for a rendered context
+def onboarding_letter_path(context):
+    return ONBOARDED_DIR / f'onboarding_letter_{context["VORNAME"]}_{context["NACHNAME"]}.pdf'.replace(" ", "_")
+
+# Result of a row that could not be rendered
+def failed_row_result(index, error, context=None):
+    return {'index': index, 'success': False, 'context': context, 'output_pdf': None, 'error': str(error)}
+
+# Render, convert and overlay a single CSV row; runs inside a render worker
+def render_row(index, record):
+    failed, letters = render_letters([(index, record)], batch=False)
+    return (failed + overlay_letters(letters))[0]
+
+# Link placed at the top of every person's section in a batch document. wkhtmltopdf turns it into a link
+# annotation on the page where the section starts; the annotations are removed again when the letters are split,
+# so nothing of the marker ends up in a letter. The .invalid domain can never resolve.
+BATCH_MARKER_URL = 'https://onboarding.invalid/person/'
+BATCH_MARKER_PATTERN = re.compile(re.escape(BATCH_MARKER_URL) + r'(\d+)$')
+
+# Combine the rendered letters of several people into one HTML document with a forced page break per person
+def build_batch_html(html_documents):
+    head_match = re.search(r'^(.*?<body[^>]*>)', html_documents[0], re.S | re.I)
+    head = head_match.group(1) if head_match else '<html><body>'
+
+    sections = []
+    for position, html_content in enumerate(html_documents):
+        body_match = re.search(r'<body[^>]*>(.*)</body>', html_content, re.S | re.I)
+        body = body_match.group(1) if body_match else html_content
+        page_break = '' if position == 0 else 'page-break-before: always;'
+        # An empty 1px link: it has no text, but needs a size for wkhtmltopdf to create its annotation
+        marker = f'<a href="{BATCH_MARKER_URL}{position}" style="display: block; width: 1px; height: 1px;"></a>'
+        sections.append(f'<div style="{page_break}">{marker}{body}</div>')
+
+    return head + '\n'.join(sections) + '\n</body>\n</html>'
+
+# Return the person position of a batch marker link annotation, or None for any other annotation
+def batch_marker_position(annotation):
+    action = annotation.get_object().get('/A')
+    uri = action.get_object().get('/URI') if action is not None else None
+    match = BATCH_MARKER_PATTERN.match(str(uri)) if uri is not None else None
+    return int(match.group(1)) if match else None
+
+# The link annotations of a page, which may be stored as an indirect array
+def page_annotations(page):
+    annotations = page.get('/Annots')
+    return list(annotations.get_object()) if annotations is not None else []
+
+# Remove the batch marker links from a page before it is written into a letter
+def strip_batch_markers(page):
+    from PyPDF2.generic import ArrayObject, NameObject
+    if '/Annots' not in page:
+        return page
+    # The remaining links are kept as direct objects, so they travel with the page dictionary when the page is
+    # copied into the letter's writer instead of referring back into the batch document
+    kept = [annotation.get_object() for annotation in page_annotations(page) if batch_marker_position(annotation) is None]
+    if kept:
+        page[NameObject('/Annots')] = ArrayObject(kept)
+    else:
+        del page['/Annots']
+    return page
+
+# Find the first page of every person in a batch PDF from the markers written by build_batch_html
+def find_batch_page_ranges(pages, people_count):
+    starts = []
+    for page_num, page in enumerate(pages):
+        for annotation in page_annotations(page):
+            position = batch_marker_position(annotation)
+            if position is not None:
+                starts.append((position, page_num))
+
+    # Every person must appear exactly once and in order, otherwise the split cannot be trusted
+    if [position for position, _ in starts] != list(range(people_count)):
+        return None
+
+    page_starts = [page_num for _, page_num in starts] + [len(pages)]
+    return [(page_starts[i], page_starts[i + 1]) for i in range(people_count)]
+
+# Render several CSV rows with one wkhtmltopdf call and split the PDF into one letter per person; runs inside a render worker
+def render_batch(rows):
+    failed, letters = render_letters(rows)
+    return failed + overlay_letters(letters)
+
+# Fill the letter template and convert it to PDF for a list of (index, record) rows.
+# Returns the failed row results and the rendered letters as (index, context, content PDF bytes, page range);
+# with batch=True the rows share one wkhtmltopdf call and the page range selects each person's pages.
+# Only plain data is returned, so this runs in render worker processes as well as threads.
+def render_letters(rows, batch=True):
+    from PyPDF2 import PdfReader
+    failed = []
+    rendered = []
+    template = get_template_env().get_template(LETTER_TEMPLATE)
+    for index, record in rows:
+        try:
+            logger.debug(f"Processing row {index}")
+            context = build_row_context(record)
+            with TEMPLATE_RENDER_SECONDS.time(template=LETTER_TEMPLATE):
+                html_content = template.render(context)
+            rendered.append((index, context, html_content))
+        except Exception as e:
+            ERRORS_TOTAL.inc(stage='render')
+            logger.error(f"Error processing row {index}: {e}")
+            failed.append(failed_row_result(index, e))
+
+    if not rendered:
+        return failed, []
+
+    if batch:
+        logger.debug(f"Generating batch PDF for {len(rendered)} rows")
+        page_ranges = None
+        batch_pdf = generate_pdf_from_html(build_batch_html([html_content for _, _, html_content in rendered]))
+        if batch_pdf is not None:
             try:
-                print(f"Processing row {index}")
-                
-                # Split "Vorname und Nachname" into first and last name
-                name_parts = row['Vorname und Nachname'].split()
-                vorname = name_parts[0]
-                nachname = " ".join(name_parts[1:])
-
-                # Chunk the multiline fields into formatted lists
-                arbeitsegeraete_list = list(chunk_list(row.get('Der Mitarbeiter Benötigt Folgende Arbeitsgeräte', '').split('\n')))
-                zugaenge_list = list(chunk_list(row.get('Die Folgenden Zugänge und Rollen Sollen Zu Workspace Eingerichtet Werden', '').split('\n')))
-                software_list = list(chunk_list(row.get('Darüber Hinaus Benötigt Er Folgende Software', '').split('\n')))
-                account_list = list(chunk_list(row.get('Zugänge, Die Standardmäßig Eingerichtet Werden Sollen, Bitte Benennen', '').split('\n')))
-                standard_zugaenge_list = row.get('Zugänge, Die Standardmäßig Eingerichtet Werden Sollen, Bitte Benennen', '').split('\n')
-                printer_list = list(chunk_list(row.get('Ressourcen, Die Standardmäßig Eingerichtet Werden Sollen, Bitte Benennen', '').split('\n')))
-                telephone = row.get('TUBS-Telefon-Direktwahl-Nr. 030 447202 (10-89)', None)
-
-
-
-                # Prepare the context with employee data
-                context = {
-                    'VORNAME': vorname,
-                    'NACHNAME': nachname,
-                    'BERUFSBEZEICHNUNG': row.get('Berufsbezeichnung', 'N/A'),
-                    'ABTEILUNG': row.get('Abteilung', 'N/A'),
-                    'EMAIL': row.get('Gewünschte Dienstliche E-Mail-Adresse', 'N/A'),
-                    'VERTRAGSBEGINN': row.get('Vertragsbeginn', 'N/A'),
-                    'UEBERGABEDATUM': row.get('Gewünschtes Übergabedatum der Geräte', 'N/A'),
-                    'GRUPPENPOSTFAECHER_ERFORDERLICH': row.get('Gruppenpostfächer Erforderlich?', 'N/A'),
-                    'ZUGAENGE_LIST': zugaenge_list,
-                    'ARBEITSGERÄTE_LIST': arbeitsegeraete_list,
-                    'SOFTWARE_LIST': software_list,
-                    'ACCOUNT_LIST': account_list,  # Pass Standard-Zugänge data
-                    'STANDARD_ZUGAENGE': row.get('Zugänge, Die Standardmäßig Eingerichtet Werden Sollen, Bitte Benennen', ''),
-                    'SOFTWAREWUNSCH': row.get('Haben Sie Einen Zusätzlichen Softwarewunsch?', ''),
-                    'STANDARD_RESSOURCEN': printer_list,
-                    'TELEFONNUMMER': telephone,
-                    'BEMERKUNGEN': row.get('Haben Wir Irgendetwas Übersehen? Schreiben Sie Uns Hier.', 'nan'),
-                    'VEREINBARUNG': row.get('Vereinbarung', ''),
-                    'UNTERSCHRIFT': row.get('Unterschrift', ''),
-                }
-
-                # Fill the template with data
-                html_content = Template(html_template).render(context)
-
-                # Generate content PDF and save to temp_pdf directory
-                content_pdf_path = TEMP_PDF_DIR / f'temp_content_{vorname}_{nachname}.pdf'
-                print(f"Generating content PDF at: {content_pdf_path}")
-                generate_pdf_from_html(html_content, str(content_pdf_path))
-
-                # Define output PDF filename and save to onboarded_person directory
-                output_pdf_path = ONBOARDED_DIR / f'onboarding_letter_{vorname}_{nachname}.pdf'.replace(" ", "_")
-
-                # Overlay content on letterhead and save final PDF
-                letterhead_pdf = TEMPLATES_DIR / 'templates.pdf'
-                print(f"Overlaying content on letterhead: {letterhead_pdf}")
-                overlay_content_on_letterhead(str(content_pdf_path), letterhead_pdf, output_pdf_path)
-
-                print(f"Final PDF generated and saved at: {output_pdf_path}")
-
-                # Email notifications based on conditions
-                # Check for "Schlüssel" in ARBEITSGERÄTE_LIST and send email
-                if any("Schlüssel".lower() in s.lower() for sublist in arbeitsegeraete_list for s in sublist if isinstance(s, str)):
-                    print(f"'Schlüssel' found for {vorname} {nachname}")
-                    send_email_notification(MINUTH_EMAIL, 'Schlüssel Required', EMAIL_TEXT_DIR / 'minuth_email.txt', context)
-
-                # Check for "HR Works" in STANDARD_ZUGAENGE_LIST and send email
-                if any("HR Works".lower() in s.lower() for s in standard_zugaenge_list if isinstance(s, str)):
-                    print(f"'HR Works' found for {vorname} {nachname}")
-                    send_email_notification(DRITICH_EMAIL, 'HR Works Access Required', EMAIL_TEXT_DIR / 'dritich_email.txt', context)
-
+                page_ranges = find_batch_page_ranges(PdfReader(io.BytesIO(batch_pdf)).pages, len(rendered))
             except Exception as e:
-                print(f"Error processing row {index}: {e}")
-
+                ERRORS_TOTAL.inc(stage='render')
+                logger.error(f"Error reading batch PDF: {e}")
+        if page_ranges is not None:
+            return failed, [(index, context, batch_pdf, page_range) for (index, context, _), page_range in zip(rendered, page_ranges)]
+
+        # Fall back to rendering row by row so a single bad row cannot take the whole batch down
+        logger.warning(f"Batch rendering failed for rows {[index for index, _, _ in rendered]}, rendering them one by one")
+
+    letters = []
+    for index, context, html_content in rendered:
+        # Generate the content PDF in memory
+        content_pdf = generate_pdf_from_html(html_content)
+        if content_pdf is None:
+            logger.error(f"Error processing row {index}: wkhtmltopdf failed")
+            failed.append(failed_row_result(index, f"wkhtmltopdf failed for row {index}", context))
+        else:
+            letters.append((index, context, content_pdf, None))
+    return failed, letters
+
+# Overlay rendered letters onto the letterhead and save one final PDF per person in ONBOARDED_DIR
+def overlay_letters(letters):
+    from PyPDF2 import PdfReader
+    ONBOARDED_DIR.mkdir(parents=True, exist_ok=True)
+    results = []
+    # Letters of one batch share the same PDF, which is parsed only once
+    readers = {}
+    letterhead_pdf = TEMPLATES_DIR / 'templates.pdf'
+    for index, context, content_pdf, page_range in letters:
+        output_pdf_path = onboarding_letter_path(context)
+        try:
+            reader = readers.get(id(content_pdf))
+            if reader is None:
+                reader = readers[id(content_pdf)] = PdfReader(io.BytesIO(content_pdf))
+            pages = reader.pages if page_range is None else reader.pages[page_range[0]:page_range[1]]
+            pages = [strip_batch_markers(page) for page in pages]
+            if not overlay_pages_on_letterhead(pages, letterhead_pdf, output_pdf_path):
+                raise Exception(f"Overlay failed for {output_pdf_path}")
+        except Exception as e:
+            logger.error(f"Error processing row {index}: {e}")
+            results.append(failed_row_result(index, e, context))
+            continue
+
+        logger.debug(f"Final PDF generated and saved at: {output_pdf_path}")
+        results.append({'index': index, 'success': True, 'context': context, 'output_pdf': output_pdf_path, 'error': None})
+    return results
+
+# Send the notification emails for a successfully rendered row
+def send_row_notifications(context):
+    vorname, nachname = context['VORNAME'], context['NACHNAME']
+    standard_zugaenge_list = context['STANDARD_ZUGAENGE'].split('\n')
+
+    # Check for "Schlüssel" in ARBEITSGERÄTE_LIST and send email
+    if any("Schlüssel".lower() in s.lower() for sublist in context['ARBEITSGERÄTE_LIST'] for s in sublist if isinstance(s, str)):
+        logger.info(f"'Schlüssel' found for {vorname} {nachname}")
+        send_email_notification(MINUTH_EMAIL, 'Schlüssel Required', 'minuth_email.txt', context)
+
+    # Check for "HR Works" in STANDARD_ZUGAENGE_LIST and send email
+    if any("HR Works".lower() in s.lower() for s in standard_zugaenge_list if isinstance(s, str)):
+        logger.info(f"'HR Works' found for {vorname} {nachname}")
+        send_email_notification(DRITICH_EMAIL, 'HR Works Access Required', 'dittrich_email.txt', context)
+
+# Create the worker pool used for rendering, as configured by RENDER_POOL and RENDER_WORKERS
+def create_render_pool():
+    if RENDER_POOL == 'process':
+        return ProcessPoolExecutor(max_workers=RENDER_WORKERS)
+    return ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix='render')
+
+# Group records into render batches while reading them, holding at most RENDER_WORKERS batches in memory
+def iter_render_batches(records):
+    batch_size = RENDER_BATCH_SIZE if RENDER_MODE == 'batch' else 1
+    window = batch_size * RENDER_WORKERS
+    buffer = []
+    for item in records:
+        buffer.append(item)
+        if len(buffer) >= window:
+            for i in range(0, len(buffer), batch_size):
+                yield buffer[i:i + batch_size]
+            buffer = []
+    if buffer:
+        # Spread a short tail over all workers instead of handing it to one
+        batch_size = min(batch_size, max(1, -(-len(buffer) // RENDER_WORKERS)))
+        for i in range(0, len(buffer), batch_size):
+            yield buffer[i:i + batch_size]
+
+# Collect the results of one finished render batch and, unless notify is False, send the emails for its rendered rows
+def collect_render_batch(batch, future, notify=True):
+    try:
+        batch_results = future.result()
+        batch_results = batch_results if isinstance(batch_results, list) else [batch_results]
     except Exception as e:
-        print(f"Error processing CSV {csv_file}: {e}")
+        # The worker itself died (e.g. a crashed process), so only the rows of this batch are lost
+        batch_results = []
+        for index, _ in batch:
+            logger.error(f"Error processing row {index}: {e}")
+            batch_results.append(failed_row_result(index, e))
+
+    # Email notifications only for rows whose letter was rendered
+    for result in batch_results:
+        if notify and result['success']:
+            try:
+                send_row_notifications(result['context'])
+            except Exception as e:
+                logger.error(f"Error sending notifications for row {result['index']}: {e}")
+    return batch_results
+
+# Drop records that were already rendered and notified with identical content, remembering the fingerprints of the rest.
+# With claim set, the rows are also claimed in the ledger, so identical rows that are still being processed are dropped too;
+# the caller releases the claims once the rows were recorded. With force set, no row is dropped, but the fingerprints
+# are still remembered, so the rows of a forced run are recorded like any other.
+def iter_changed_records(records, ledger, fingerprints, claim=False, force=False):
+    for index, record in records:
+        key = record_key(record)
+        fingerprint = record_fingerprint(record)
+        if force:
+            skip = False
+        elif claim:
+            skip = not ledger.claim_row(key, fingerprint)
+        else:
+            skip = ledger.is_row_current(key, fingerprint)
+        if skip:
+            logger.debug(f"Row {index} ({record.name}) is unchanged since it was last processed, skipping")
+            continue
+        fingerprints[index] = (key, fingerprint)
+        yield index, record
+
+# Record the rendered rows of a CSV file in the processing ledger and save it.
+# Only rows that rendered are recorded, and the file only once all of its rows rendered,
+# so failed rows are retried when the file comes in again
+def record_csv_results(ledger, csv_file, content_hash, results, fingerprints):
+    for result in results:
+        if result['success'] and result['index'] in fingerprints:
+            ledger.mark_row(*fingerprints[result['index']])
+    if all(result['success'] for result in results):
+        ledger.mark_file(content_hash, csv_file)
+    ledger.save()
+
+    succeeded = sum(1 for result in results if result['success'])
+    ROWS_TOTAL.inc(succeeded, result='success')
+    ROWS_TOTAL.inc(len(results) - succeeded, result='failed')
+    logger.info(f"Rendered {succeeded} of {len(results)} rows from {csv_file}")
+
+# Render (index, record) rows into letters with the worker pool and return one result per row.
+# Rows are fed to the pool as they are read and only a bounded number of batches is in flight.
+def render_records(records, notify=True):
+    results = []
+    with create_render_pool() as pool:
+        in_flight = deque()
+        for batch in iter_render_batches(records):
+            if RENDER_MODE == 'batch':
+                in_flight.append((batch, pool.submit(render_batch, batch)))
+            else:
+                in_flight.append((batch, pool.submit(render_row, *batch[0])))
+            if len(in_flight) >= 2 * RENDER_WORKERS:
+                results.extend(collect_render_batch(*in_flight.popleft(), notify=notify))
+        while in_flight:
+            results.extend(collect_render_batch(*in_flight.popleft(), notify=notify))
+    return results
+
+# Fill the letter template for (index, record) rows without converting or writing anything,
+# so a CSV export or template change can be checked before letters are generated
+def check_records(records):
+    results = []
+    template = get_template_env().get_template(LETTER_TEMPLATE)
+    for index, record in records:
+        try:
+            context = build_row_context(record)
+            template.render(context)
+        except Exception as e:
+            logger.error(f"Error processing row {index}: {e}")
+            results.append(failed_row_result(index, e))
+            continue
+        results.append({'index': index, 'success': True, 'context': context,
+                        'output_pdf': onboarding_letter_path(context), 'error': None})
+    return results
 
+# Function to process CSV and generate PDF with email feature
+# Returns one result per processed row so callers can tell which rows rendered successfully.
+# Files and rows recorded in the processing ledger are skipped unless force is set.
+def process_csv_and_generate_pdf(csv_file, force=False):
+    results = []
+    try:
+        logger.info(f"Processing CSV file: {csv_file}")
+        ledger = get_processing_ledger()
+        content_hash = file_sha256(csv_file)
+        if ledger.has_file(content_hash) and not force:
+            logger.info(f"CSV file {csv_file} was already processed, skipping")
+            return results
+
+        # Rows are read lazily and fed to the render pool as they come; only a bounded
+        # number of batches is in flight, so memory stays flat for large exports
+        fingerprints = {}
+        records = metrics.timed_iter(iter_csv_records(csv_file), CSV_PARSE_SECONDS)
+        records = iter_changed_records(records, ledger, fingerprints, force=force)
+        results = render_records(records)
+        record_csv_results(ledger, csv_file, content_hash, results, fingerprints)
 
-# Function to check email for CSV attachments
+    except Exception as e:
+        logger.error(f"Error processing CSV {csv_file}: {e}")
+    return results
+
+
+# Connect to the email server, log in and select the mailbox
+def connect_imap():
+    mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT) if IMAP_SSL else imaplib.IMAP4(IMAP_SERVER, IMAP_PORT)
+    mail.login(EMAIL_ACCOUNT, PASSWORD)
+    mail.select(MAILBOX)
+    return mail
+
+# Save one CSV section of a message to ATTACHMENTS_DIR and return its path
+def save_csv_attachment(mail, uid, part):
+    return save_csv_payload(fetch_csv_section(mail, uid, part), part)
+
+# Download one CSV section of a message, still in its transfer encoding
+def fetch_csv_section(mail, uid, part):
+    # Only this MIME section is downloaded; PEEK leaves the \Seen flag alone until the message is done
+    with IMAP_FETCH_SECONDS.time(item='section'):
+        status, data = mail.uid('FETCH', uid, f"(BODY.PEEK[{part['section']}])")
+    if status != 'OK':
+        raise Exception(f"Failed to fetch section {part['section']} of message {uid.decode()}")
+    return parse_fetch_response(data)[0].get(f"BODY[{part['section']}]") or b''
+
+# Decode a downloaded CSV section into a new file in ATTACHMENTS_DIR and return its path
+def write_csv_payload(payload, part):
+    # Save the CSV attachment with a unique name; parts without a filename get a generic one
+    filename = Path(part['filename'] or 'attachment.csv').name
+    unique_filename = f"{filename.split('.')[0]}_{uuid.uuid4().hex}.csv"
+    ATTACHMENTS_DIR.mkdir(parents=True, exist_ok=True)
+    filepath = ATTACHMENTS_DIR / unique_filename
+    with open(filepath, "wb") as f:
+        decode_part_to_file(payload, part['encoding'], f)
+    return filepath
+
+# Decode a downloaded CSV section into ATTACHMENTS_DIR; returns None for a file that was already processed
+def save_csv_payload(payload, part):
+    filepath = write_csv_payload(payload, part)
+
+    # A re-delivered or forwarded copy of a file that was already processed is not kept
+    if get_processing_ledger().has_file(file_sha256(filepath)):
+        logger.info(f"CSV attachment {part['filename'] or filepath.name} was already processed, skipping")
+        filepath.unlink()
+        return None
+
+    logger.info(f"CSV file saved as {filepath}")
+    return filepath
+
+# Process all unread emails on an open IMAP connection
+# With handle_attachment set, every downloaded CSV section is passed to it as (payload, part) instead of
+# being saved and processed here; the email is marked as read once all of its sections were handed over.
+def process_unseen_emails(mail, handle_attachment=None):
+    # Search for all unread emails
+    status, messages = mail.uid('SEARCH', None, '(UNSEEN)')
+    uids = messages[0].split()
+    if not uids:
+        return
+
+    # One batched FETCH for the structure and subject of every unread email; no message bodies are downloaded here
+    with IMAP_FETCH_SECONDS.time(item='structure'):
+        status, data = mail.uid('FETCH', b','.join(uids), '(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (SUBJECT)])')
+    if status != 'OK':
+        raise Exception(f"Failed to fetch message structure: {data}")
+
+    for message in parse_fetch_response(data):
+        uid = message.get('UID')
+        try:
+            header = email.message_from_bytes(message.get('BODY[HEADER.FIELDS (SUBJECT)]') or b'')
+            subject = str(make_header(decode_header(header['Subject'] or '')))
+            logger.info(f"Processing email: {subject}")
+
+            # Download only the sections that are CSV attachments
+            csv_files = []
+            for part in find_csv_parts(message['BODYSTRUCTURE']):
+                if handle_attachment is not None:
+                    handle_attachment(fetch_csv_section(mail, uid, part), part)
+                else:
+                    csv_files.append(save_csv_attachment(mail, uid, part))
+        except imaplib.IMAP4.abort:
+            raise
+        except Exception as e:
+            ERRORS_TOTAL.inc(stage='imap')
+            logger.error(f"Failed to process email {uid}: {e}")
+            continue
+
+        # Mark the email as read once its attachments are saved, as fetching the full message used to
+        mail.uid('STORE', uid, '+FLAGS', '(\\Seen)')
+
+        # Process CSV and generate PDF
+        for filepath in csv_files:
+            if filepath is not None:
+                process_csv_and_generate_pdf(filepath)
+
+# Function to check email for CSV attachments once, on a new connection; returns False if the mailbox could not be checked
 def check_email_for_csv():
     try:
-        # Connect to the email server
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER)
-        mail.login(EMAIL_ACCOUNT, PASSWORD)
-        mail.select(MAILBOX)
-
-        # Search for all unread emails
-        status, messages = mail.search(None, '(UNSEEN)')
-        email_ids = messages[0].split()
-
-        for e_id in email_ids:
-            res, msg = mail.fetch(e_id, "(RFC822)")
-            for response_part in msg:
-                if isinstance(response_part, tuple):
-                    msg = email.message_from_bytes(response_part[1])
-                    subject, encoding = decode_header(msg["Subject"])[0]
-
-                    if isinstance(subject, bytes):
-                        subject = subject.decode(encoding or "utf-8")
-
-                    print(f"Processing email: {subject}")
-
-                    # Loop through email parts to find attachments
-                    if msg.is_multipart():
-                        for part in msg.walk():
-                            content_disposition = str(part.get("Content-Disposition"))
-                            if "attachment" in content_disposition:
-                                filename = part.get_filename()
-
-                                if filename.endswith(".csv"):
-                                    # Save the CSV attachment with a unique name
-                                    unique_filename = f"{filename.split('.')[0]}_{uuid.uuid4().hex}.csv"
-                                    filepath = ATTACHMENTS_DIR / unique_filename
-                                    with open(filepath, "wb") as f:
-                                        f.write(part.get_payload(decode=True))
-                                    print(f"CSV file saved as {filepath}")
-
-                                    # Process CSV and generate PDF
-                                    process_csv_and_generate_pdf(filepath)
-
+        mail = connect_imap()
+        process_unseen_emails(mail)
         mail.logout()
+        return True
     except Exception as e:
-        print(f"Failed to check email: {e}")
-
-# Countdown timer for 30 seconds before checking again
-def countdown_timer(seconds):
-    for i in range(seconds, 0, -1):
-        print(f"Waiting {i} seconds...", end="\r")
-        time.sleep(1)
-    print("Checking emails now...")
-
-# Continuously check for new emails every 30 seconds
-while True:
-    check_email_for_csv()
-    countdown_timer(SYNC_INTERVAL)
+        ERRORS_TOTAL.inc(stage='imap')
+        logger.error(f"Failed to check email: {e}")
+    return False
+
+# Read one CRLF-terminated line straight from the socket; returns (None, buffer) when the deadline passes first
+def _read_imap_line(sock, buffer, deadline):
+    while b'\r\n' not in buffer:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None, buffer
+        sock.settimeout(remaining)
+        try:
+            chunk = sock.recv(4096)
+        except socket.timeout:
+            return None, buffer
+        if not chunk:
+            raise imaplib.IMAP4.abort("IMAP connection closed by server")
+        buffer += chunk
+    line, buffer = buffer.split(b'\r\n', 1)
+    return line, buffer
+
+# Wait in IMAP IDLE until the server reports new mail or the timeout expires
+# Returns True when new mail was announced. The socket is read directly because
+# imaplib's buffered reader becomes unusable after a read timeout.
+def idle_wait(mail, timeout):
+    tag = mail._new_tag()
+    mail.send(tag + b' IDLE\r\n')
+    sock = mail.sock
+    buffer = b''
+    new_mail = False
+    try:
+        line, buffer = _read_imap_line(sock, buffer, time.monotonic() + IMAP_RESPONSE_TIMEOUT)
+        if line is None or not line.startswith(b'+'):
+            raise imaplib.IMAP4.abort(f"IDLE was not accepted by the server: {line!r}")
+
+        deadline = time.monotonic() + timeout
+        while not new_mail:
+            line, buffer = _read_imap_line(sock, buffer, deadline)
+            if line is None:
+                break
+            if line.startswith(b'* BYE'):
+                raise imaplib.IMAP4.abort(f"Server closed the IDLE session: {line!r}")
+            if line.startswith(b'* ') and (line.endswith(b'EXISTS') or line.endswith(b'RECENT')):
+                new_mail = True
+
+        # Leave IDLE and wait for the tagged completion of the IDLE command
+        mail.send(b'DONE\r\n')
+        response_deadline = time.monotonic() + IMAP_RESPONSE_TIMEOUT
+        while True:
+            line, buffer = _read_imap_line(sock, buffer, response_deadline)
+            if line is None:
+                raise imaplib.IMAP4.abort("No response to IDLE DONE")
+            if line.startswith(tag):
+                if not line[len(tag):].strip().upper().startswith(b'OK'):
+                    raise imaplib.IMAP4.error(f"IDLE failed: {line!r}")
+                break
+    finally:
+        sock.settimeout(None)
+    return new_mail
+
+# Take the EXISTS/RECENT responses imaplib collected from the previous commands. Mail that arrives while the
+# session is busy is announced in these responses and not during the next IDLE, so it has to be checked here.
+def pop_new_mail_responses(mail):
+    new_mail = False
+    for response in ('EXISTS', 'RECENT'):
+        if mail.untagged_responses.pop(response, None):
+            new_mail = True
+    return new_mail
+
+# Keep one authenticated IMAP session open and process new mail as soon as it arrives.
+# Uses IDLE when the server supports it and polls with NOOP keepalives otherwise; reconnects automatically.
+# handle_attachment is passed on to process_unseen_emails.
+def watch_mailbox(handle_attachment=None):
+    reconnect_delay = IMAP_RECONNECT_DELAY
+    while True:
+        mail = None
+        try:
+            mail = connect_imap()
+            reconnect_delay = IMAP_RECONNECT_DELAY
+            # Ask again after login: some servers only advertise IDLE to authenticated clients
+            typ, capability_data = mail.capability()
+            use_idle = IMAP_IDLE and b'IDLE' in capability_data[0].upper().split()
+            logger.info(f"Connected to {IMAP_SERVER}, waiting for new mail using {'IDLE' if use_idle else 'polling'}...")
+            # The mailbox counts reported by SELECT are covered by the first pass below
+            pop_new_mail_responses(mail)
+
+            while True:
+                process_unseen_emails(mail, handle_attachment)
+                if pop_new_mail_responses(mail):
+                    logger.debug("New mail arrived while processing, checking again")
+                    continue
+                if use_idle:
+                    if not idle_wait(mail, IMAP_IDLE_TIMEOUT):
+                        # Nothing arrived; keep the session alive before re-entering IDLE
+                        mail.noop()
+                else:
+                    time.sleep(SYNC_INTERVAL)
+                    mail.noop()
+
+        except Exception as e:
+            logger.warning(f"IMAP session failed: {e}. Reconnecting in {reconnect_delay} seconds...")
+            time.sleep(reconnect_delay)
+            reconnect_delay = min(reconnect_delay * 2, IMAP_MAX_RECONNECT_DELAY)
+        finally:
+            if mail is not None:
+                try:
+                    mail.logout()
+                except Exception:
+                    pass
+
+# Wait until the queued notification emails were delivered, so a one-shot command does not exit before they are sent
+def flush_mail_outbox():
+    if mail_outbox is not None:
+        mail_outbox.flush()
+
+# poll: check the mailbox once, or keep the session open with --watch
+def command_poll(args):
+    if args.watch:
+        metrics.start_metrics_server()
+        watch_mailbox()
+        return 0
+    checked = check_email_for_csv()
+    flush_mail_outbox()
+    return 0 if checked else 1
+
+# process-csv: render, notify and record CSV files that are already on disk
+def command_process_csv(args):
+    failed = 0
+    for csv_file in args.files:
+        if not Path(csv_file).is_file():
+            logger.error(f"CSV file {csv_file} does not exist")
+            failed += 1
+            continue
+        results = process_csv_and_generate_pdf(Path(csv_file), force=args.force)
+        failed += sum(1 for result in results if not result['success'])
+    flush_mail_outbox()
+    return 1 if failed else 0
+
+# render: generate the letters of CSV files without sending emails or touching the processing ledger
+def command_render(args):
+    failed = 0
+    for csv_file in args.files:
+        try:
+            records = iter_csv_records(csv_file)
+            results = check_records(records) if args.dry_run else render_records(records, notify=False)
+        except Exception as e:
+            logger.error(f"Error processing CSV {csv_file}: {e}")
+            failed += 1
+            continue
+        for result in results:
+            if result['success']:
+                logger.info(f"Row {result['index']}: {result['output_pdf']}{' (dry run, not written)' if args.dry_run else ''}")
+        succeeded = sum(1 for result in results if result['success'])
+        failed += len(results) - succeeded
+        logger.info(f"{'Checked' if args.dry_run else 'Rendered'} {succeeded} of {len(results)} rows from {csv_file}")
+    return 1 if failed else 0
+
+# sync: upload new and modified files to Nextcloud once, or run the synchronization service
+def command_sync(args):
+    # Imported here so the other commands neither load requests nor need the Nextcloud settings
+    import syn_nextcloud
+    if args.once:
+        return 0 if syn_nextcloud.sync_once() else 1
+    else:
+        metrics.start_metrics_server()
+        syn_nextcloud.run_sync_service()
+    return 0
+
+# serve: run the whole service, from new mail to uploaded letters, in one pipeline until interrupted
+def command_serve(args):
+    # Imported here as the pipeline loads the Nextcloud settings and the other commands do not need them
+    import pipeline
+    metrics.start_metrics_server()
+    logger.info("Starting onboarding pipeline...")
+    pipeline.OnboardingPipeline().run()
+    return 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='main.py',
+        description='Onboarding letters from emailed CSV exports. Without a command the whole service runs (serve).')
+    parser.add_argument('--log-level', help='minimum log level, e.g. DEBUG or WARNING (default: LOG_LEVEL or INFO)')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    serve = commands.add_parser('serve', help='run the service: watch the mailbox, render, notify and upload (default)')
+    serve.set_defaults(handler=command_serve)
+
+    poll = commands.add_parser('poll', help='process unread emails with CSV attachments once and exit')
+    poll.add_argument('--watch', action='store_true', help='keep the IMAP session open and wait for new mail (IDLE)')
+    poll.set_defaults(handler=command_poll)
+
+    process_csv = commands.add_parser('process-csv', help='render, notify and record CSV files already on disk')
+    process_csv.add_argument('files', nargs='+', metavar='file', help='CSV export to process')
+    process_csv.add_argument('--force', action='store_true', help='also process files and rows that were processed before')
+    process_csv.set_defaults(handler=command_process_csv)
+
+    render = commands.add_parser('render', help='render the letters of CSV files without sending emails or updating the ledger')
+    render.add_argument('files', nargs='+', metavar='file', help='CSV export to render')
+    render.add_argument('--dry-run', action='store_true', help='only fill the template and report the rows, write nothing')
+    render.set_defaults(handler=command_render)
+
+    sync = commands.add_parser('sync', help='upload new and modified files to Nextcloud')
+    sync.add_argument('--once', action='store_true', help='synchronize all folders once and exit')
+    sync.set_defaults(handler=command_sync)
+
+    parser.set_defaults(handler=command_serve)
+    return parser
+
+def run_cli(argv=None):
+    args = build_parser().parse_args(argv)
+    metrics.setup_logging(args.log_level)
+    try:
+        return args.handler(args)
+    except KeyboardInterrupt:
+        return 130
+
+# The guard keeps spawned render processes from entering the mail loop when they import this module
+if __name__ == "__main__":
+    sys.exit(run_cli())
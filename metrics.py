@@ -0,0 +1,286 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Histogram buckets in seconds, from a template render up to a large chunked upload
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    # Integers stay exact; floats use the shortest repr that round-trips
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _samples(self):
+        with self.lock:
+            return [(self.name, _format_labels(self.labelnames, key), value) for key, value in self.values.items()]
+
+    def expose(self):
+        """Return the metric in the Prometheus text format."""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(f'{name}{labels} {_format_value(value)}' for name, labels, value in self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """A value that only goes up, such as processed rows or errors."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Add amount to the counter for the given labels."""
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, such as a queue depth; it may be read from a callback when scraped."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.functions = {}
+
+    def set(self, value, **labels):
+        """Set the gauge for the given labels."""
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def set_function(self, function, **labels):
+        """Read the gauge from function() whenever the metrics are scraped."""
+        with self.lock:
+            self.functions[self._key(labels)] = function
+
+    def _samples(self):
+        samples = super()._samples()
+        with self.lock:
+            functions = list(self.functions.items())
+        for key, function in functions:
+            try:
+                samples.append((self.name, _format_labels(self.labelnames, key), function()))
+            except Exception:
+                continue
+        return samples
+
+
+class Timer(_Metric):
+    """
+    Histogram of durations in seconds, exposed with cumulative buckets, sum and count.
+
+    Use observe() with a measured duration or time() as a context manager around the timed code.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, seconds, **labels):
+        """Record one duration for the given labels."""
+        key = self._key(labels)
+        with self.lock:
+            # Bucket counts are cumulative: an observation counts for every bucket it fits into
+            counts, total, observations = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for position, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[position] += 1
+            self.values[key] = (counts, total + seconds, observations + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """Measure the duration of the enclosed block, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        samples = []
+        with self.lock:
+            values = [(key, list(counts), total, observations) for key, (counts, total, observations) in self.values.items()]
+        for key, counts, total, observations in values:
+            for bound, count in zip(self.buckets, counts):
+                samples.append((f'{self.name}_bucket', _format_labels(self.labelnames, key, [('le', f'{bound:g}')]), count))
+            samples.append((f'{self.name}_bucket', _format_labels(self.labelnames, key, [('le', '+Inf')]), observations))
+            samples.append((f'{self.name}_sum', _format_labels(self.labelnames, key), total))
+            samples.append((f'{self.name}_count', _format_labels(self.labelnames, key), observations))
+        return samples
+
+
+class Registry:
+    """All metrics of the process, by name."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def get_or_create(self, cls, name, documentation, labelnames=(), **kwargs):
+        """Return the metric with this name, creating it on first use."""
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} is already registered as a {metric.kind}")
+            return metric
+
+    def expose(self):
+        """Return all metrics in the Prometheus text format."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(metric.expose() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    """Return the counter with this name from the process registry."""
+    return REGISTRY.get_or_create(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    """Return the gauge with this name from the process registry."""
+    return REGISTRY.get_or_create(Gauge, name, documentation, labelnames)
+
+
+def timer(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    """Return the timer (histogram in seconds) with this name from the process registry."""
+    return REGISTRY.get_or_create(Timer, name, documentation, labelnames, buckets=buckets)
+
+
+def timed_iter(iterable, metric, **labels):
+    """
+    Yield the items of a lazy iterable, timing only how long producing each item takes.
+
+    Args:
+        iterable (iterable): The iterable to time, e.g. a streaming CSV reader.
+        metric (Timer): The timer that records one observation per item.
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        metric.observe(time.perf_counter() - start, **labels)
+        yield item
+
+
+def start_metrics_server(port=None, host=None):
+    """
+    Serve the metrics in the Prometheus text format on a background thread.
+
+    Args:
+        port (int): Port to listen on; defaults to METRICS_PORT (9108), 0 disables the endpoint.
+        host (str): Address to bind to; defaults to METRICS_HOST, the loopback interface.
+
+    Returns:
+        ThreadingHTTPServer: The running server, or None if disabled or the port is taken.
+    """
+    # Read when called, so values from env/.env loaded by the entry point apply
+    port = int(os.getenv('METRICS_PORT', 9108)) if port is None else port
+    host = host or os.getenv('METRICS_HOST', '127.0.0.1')
+    if not port:
+        return None
+
+    # Imported here, as one-shot commands never serve metrics
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = REGISTRY.expose().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        logger.warning("Metrics endpoint not started on %s:%s: %s", host, port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return server
+
+
+# Attributes every LogRecord has; anything else was passed with extra= and is added to the JSON line
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as one JSON object per line, including fields passed with extra=."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def setup_logging(level=None):
+    """
+    Send all log records to stderr as JSON lines.
+
+    Args:
+        level (str): The minimum level, e.g. 'DEBUG', 'INFO' or 'WARNING'; defaults to LOG_LEVEL (INFO).
+    """
+    level = (level or os.getenv('LOG_LEVEL', 'INFO')).strip().upper()
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
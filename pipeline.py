@@ -0,0 +1,282 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+import main
+import metrics
+import syn_nextcloud
+from processing_ledger import file_sha256
+
+# Items that may wait between two stages; a full queue blocks the stage in front of it
+PIPELINE_QUEUE_SIZE = max(1, int(os.getenv('PIPELINE_QUEUE_SIZE', 8)))
+
+logger = logging.getLogger(__name__)
+
+STAGE_SECONDS = metrics.timer('onboarding_stage_seconds', 'Time a pipeline stage spent on one item, by stage.', ('stage',))
+STAGE_ERRORS_TOTAL = metrics.counter('onboarding_stage_errors_total', 'Items a pipeline stage dropped after an error.', ('stage',))
+QUEUE_DEPTH = metrics.gauge('onboarding_pipeline_queue_depth', 'Items waiting in front of a pipeline stage.', ('stage',))
+
+
+class Stage:
+    """
+    One pipeline stage: worker threads that take items from a bounded input queue and hand them to a handler.
+
+    Because the queue is bounded, put() blocks while the stage is behind, which slows the stages in front
+    of it down instead of letting work pile up in memory.
+
+    Args:
+        name (str): Name of the stage, used for the worker threads and in log messages.
+        handler (callable): Called with every item; exceptions are logged and the item is dropped.
+        workers (int): Number of worker threads.
+        queue_size (int): Maximum number of items waiting in the input queue.
+    """
+
+    def __init__(self, name, handler, workers=1, queue_size=PIPELINE_QUEUE_SIZE):
+        self.name = name
+        self.handler = handler
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = [
+            threading.Thread(target=self._run, name=f'{name}-{number}', daemon=True)
+            for number in range(max(1, workers))
+        ]
+        QUEUE_DEPTH.set_function(self.queue.qsize, stage=name)
+
+    def start(self):
+        """Start the worker threads."""
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item):
+        """Queue an item, waiting while the queue is full."""
+        self.queue.put(item)
+
+    def stop(self):
+        """Process everything that is queued, then stop the worker threads."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            start = time.perf_counter()
+            try:
+                self.handler(item)
+            except Exception as e:
+                STAGE_ERRORS_TOTAL.inc(stage=self.name)
+                logger.exception(f"Error in pipeline stage {self.name}: {e}")
+            finally:
+                STAGE_SECONDS.observe(time.perf_counter() - start, stage=self.name)
+
+
+class CsvJob:
+    """
+    Progress of one CSV file through the pipeline.
+
+    The parse stage adds rows as it reads them; every row is finished exactly once, either when it failed
+    or after its notifications were queued. Once the file has been read completely and every row is
+    finished, the results are recorded in the processing ledger.
+
+    Args:
+        csv_file (Path): The saved CSV attachment.
+        content_hash (str): SHA-256 of the file, as used by the processing ledger.
+    """
+
+    def __init__(self, csv_file, content_hash):
+        self.csv_file = csv_file
+        self.content_hash = content_hash
+        self.fingerprints = {}
+        self.results = []
+        self.pending = 0
+        self.parsed = False
+        self.lock = threading.Lock()
+
+    def add_rows(self, count):
+        """Count rows that were handed to the render stage."""
+        with self.lock:
+            self.pending += count
+
+    def finish_row(self, result):
+        """
+        Record the result of one row.
+
+        Returns:
+            bool: True if this was the last outstanding row of a completely read file.
+        """
+        with self.lock:
+            self.results.append(result)
+            self.pending -= 1
+            return self.parsed and self.pending == 0
+
+    def finish_parsing(self):
+        """
+        Mark the file as completely read.
+
+        Returns:
+            bool: True if no rows are outstanding, i.e. the job is complete.
+        """
+        with self.lock:
+            self.parsed = True
+            return self.pending == 0
+
+
+class OnboardingPipeline:
+    """
+    One service from mail ingestion to Nextcloud upload, with bounded queues between the stages.
+
+    fetch (the IMAP session) -> save attachment -> parse -> render -> notify, while the save and render
+    stages also hand every written file to the upload stage. A render task converts a batch of rows and
+    overlays the letters onto the letterhead inside the render pool, so both run RENDER_WORKERS wide. A letter is uploaded as soon as it was
+    written instead of waiting for the next folder scan, and a slow stage holds back the stages before it.
+    A full folder synchronization every SYNC_INTERVAL seconds retries uploads that failed.
+    """
+
+    def __init__(self):
+        self.ledger = main.get_processing_ledger()
+        self.render_pool = None
+        self.session = None
+        self.state = None
+        self.stopping = threading.Event()
+        self.rescan_thread = threading.Thread(target=self._rescan, name='rescan', daemon=True)
+        self.save_stage = Stage('save', self._save)
+        self.parse_stage = Stage('parse', self._parse)
+        self.render_stage = Stage('render', self._render, workers=main.RENDER_WORKERS)
+        self.notify_stage = Stage('notify', self._notify)
+        self.upload_stage = Stage('upload', self._upload, workers=syn_nextcloud.UPLOAD_WORKERS)
+        # In pipeline order, so stopping drains every stage before the ones behind it are stopped
+        self.stages = [self.save_stage, self.parse_stage, self.render_stage, self.notify_stage, self.upload_stage]
+
+    def start(self):
+        """Catch up with a full folder synchronization, start all stages and the periodic rescan."""
+        self.render_pool = main.create_render_pool()
+        self.session = syn_nextcloud.create_session()
+        self.state = syn_nextcloud.open_sync_state()
+        syn_nextcloud.create_local_folders()
+        logger.info("Starting initial folder synchronization...")
+        syn_nextcloud.sync_folders(self.session, self.state)
+        for stage in self.stages:
+            stage.start()
+        self.rescan_thread.start()
+
+    def stop(self):
+        """Finish all queued work, wait for the outgoing mail and release the resources."""
+        self.stopping.set()
+        self.rescan_thread.join()
+        for stage in self.stages:
+            stage.stop()
+        self.render_pool.shutdown()
+        main.get_mail_outbox().flush()
+        self.state.close()
+        self.session.close()
+
+    def submit_attachment(self, payload, part):
+        """Hand a downloaded CSV section to the save stage; called from the IMAP session."""
+        self.save_stage.put((payload, part))
+
+    def submit_csv(self, csv_file):
+        """Process a CSV file that is already on disk."""
+        content_hash = file_sha256(csv_file)
+        if not self.ledger.claim_file(content_hash):
+            logger.info(f"CSV file {csv_file} was already processed or is being processed, skipping")
+            return
+        self.parse_stage.put((csv_file, content_hash))
+
+    def run(self):
+        """Run the service until interrupted, fetching new mail with the persistent IMAP session."""
+        self.start()
+        try:
+            main.watch_mailbox(self.submit_attachment)
+        finally:
+            self.stop()
+
+    def _save(self, item):
+        payload, part = item
+        csv_file = main.write_csv_payload(payload, part)
+        content_hash = file_sha256(csv_file)
+        # The claim also covers copies whose first copy is still in the pipeline and not recorded in the ledger yet
+        if not self.ledger.claim_file(content_hash):
+            logger.info(f"CSV attachment {part['filename'] or csv_file.name} was already processed or is being processed, skipping")
+            csv_file.unlink()
+            return
+        logger.info(f"CSV file saved as {csv_file}")
+        self.upload_stage.put(csv_file)
+        self.parse_stage.put((csv_file, content_hash))
+
+    def _parse(self, item):
+        csv_file, content_hash = item
+        logger.info(f"Processing CSV file: {csv_file}")
+        job = CsvJob(csv_file, content_hash)
+        try:
+            records = metrics.timed_iter(main.iter_csv_records(csv_file), main.CSV_PARSE_SECONDS)
+            records = main.iter_changed_records(records, self.ledger, job.fingerprints, claim=True)
+            # Same batching as process_csv_and_generate_pdf, which spreads a short file over all render workers
+            for batch in main.iter_render_batches(records):
+                job.add_rows(len(batch))
+                self.render_stage.put((job, batch))
+        except Exception as e:
+            # Counted as a failed row, so the file is not recorded as processed
+            logger.error(f"Error processing CSV {csv_file}: {e}")
+            job.add_rows(1)
+            self._finish_row(job, main.failed_row_result(None, e))
+        if job.finish_parsing():
+            self._complete(job)
+
+    def _render(self, item):
+        job, batch = item
+        try:
+            if main.RENDER_MODE == 'batch':
+                results = self.render_pool.submit(main.render_batch, batch).result()
+            else:
+                results = [self.render_pool.submit(main.render_row, *batch[0]).result()]
+        except Exception as e:
+            # The worker itself died (e.g. a crashed process), so only the rows of this batch are lost
+            results = [main.failed_row_result(index, e) for index, _ in batch]
+        for result in results:
+            if result['success']:
+                self.upload_stage.put(result['output_pdf'])
+                self.notify_stage.put((job, result))
+            else:
+                self._finish_row(job, result)
+
+    def _notify(self, item):
+        job, result = item
+        try:
+            main.send_row_notifications(result['context'])
+        except Exception as e:
+            logger.error(f"Error sending notifications for row {result['index']}: {e}")
+        self._finish_row(job, result)
+
+    def _upload(self, file_path):
+        if not syn_nextcloud.sync_file(self.session, self.state, file_path):
+            logger.warning(f"Upload of {file_path} failed; it is retried by the next full synchronization.")
+
+    def _rescan(self):
+        # Uploads that failed after all retries (e.g. during a Nextcloud outage) are only retried by a full
+        # folder synchronization, which also catches files written by anything but the pipeline
+        while not self.stopping.wait(syn_nextcloud.SYNC_INTERVAL):
+            logger.debug("Starting periodic full folder synchronization...")
+            syn_nextcloud.sync_folders(self.session, self.state)
+
+    def _finish_row(self, job, result):
+        if job.finish_row(result):
+            self._complete(job)
+
+    def _complete(self, job):
+        try:
+            main.record_csv_results(self.ledger, job.csv_file, job.content_hash, job.results, job.fingerprints)
+        finally:
+            # Recorded rows and files are now skipped by the ledger itself; failed ones may come in again
+            self.ledger.release_rows(job.fingerprints.values())
+            self.ledger.release_file(job.content_hash)
+
+
+if __name__ == "__main__":
+    metrics.setup_logging()
+    metrics.start_metrics_server()
+    logger.info("Starting onboarding pipeline...")
+    OnboardingPipeline().run()
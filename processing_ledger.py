@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+
+
+def file_sha256(file_path):
+    """Return the SHA-256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def record_key(record):
+    """
+    Identify the person an onboarding record belongs to.
+
+    Args:
+        record (OnboardingRecord): The normalized CSV record.
+
+    Returns:
+        str: Lower-cased name and e-mail address, so a corrected row for the same person replaces the old one.
+    """
+    name = ' '.join((record.name or '').split()).lower()
+    email = (record.email or '').strip().lower()
+    return f"{name}|{email}"
+
+
+def record_fingerprint(record):
+    """Return a SHA-256 fingerprint over every normalized field of an onboarding record."""
+    return hashlib.sha256('\x1f'.join(value or '' for value in record.astuple()).encode('utf-8')).hexdigest()
+
+
+class ProcessingLedger:
+    """
+    Persistent record of which CSV attachments and onboarding rows have already been processed.
+
+    Files are keyed by their content hash, rows by the person (record_key) and hold the fingerprint of the
+    record that was last rendered and notified. The ledger is kept in memory and written to a JSON file
+    atomically, so a crash during the write never leaves a truncated ledger behind.
+
+    Files and rows that are being processed right now can be claimed, so a second copy that arrives before
+    the first one was recorded is recognized as a duplicate as well. Claims are not saved.
+
+    Args:
+        path (str): Location of the JSON ledger file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}
+        self.rows = {}
+        self.claimed_files = set()
+        self.claimed_rows = set()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.files = data.get('files', {})
+            self.rows = data.get('rows', {})
+
+    def has_file(self, content_hash):
+        """Return True if an attachment with this content hash was processed before."""
+        with self.lock:
+            return content_hash in self.files
+
+    def mark_file(self, content_hash, filename):
+        """Remember an attachment as processed."""
+        with self.lock:
+            self.files[content_hash] = {'filename': str(filename), 'processed_at': datetime.now().isoformat(timespec='seconds')}
+
+    def is_row_current(self, key, fingerprint):
+        """Return True if the row for this person was already processed with exactly this content."""
+        with self.lock:
+            return self.rows.get(key) == fingerprint
+
+    def mark_row(self, key, fingerprint):
+        """Remember the fingerprint of a row that was rendered and notified."""
+        with self.lock:
+            self.rows[key] = fingerprint
+
+    def claim_file(self, content_hash):
+        """
+        Reserve an attachment for processing until release_file is called.
+
+        Returns:
+            bool: False if the attachment was processed before or is being processed right now.
+        """
+        with self.lock:
+            if content_hash in self.files or content_hash in self.claimed_files:
+                return False
+            self.claimed_files.add(content_hash)
+            return True
+
+    def release_file(self, content_hash):
+        """Drop the claim on an attachment, after it was recorded with mark_file or failed."""
+        with self.lock:
+            self.claimed_files.discard(content_hash)
+
+    def claim_row(self, key, fingerprint):
+        """
+        Reserve a row for processing until release_rows is called.
+
+        Returns:
+            bool: False if the row was processed with exactly this content before or is being processed right now.
+        """
+        with self.lock:
+            if self.rows.get(key) == fingerprint or (key, fingerprint) in self.claimed_rows:
+                return False
+            self.claimed_rows.add((key, fingerprint))
+            return True
+
+    def release_rows(self, rows):
+        """Drop the claims on (key, fingerprint) rows, after they were recorded with mark_row or failed."""
+        with self.lock:
+            self.claimed_rows.difference_update(rows)
+
+    def save(self):
+        """Write the ledger to disk atomically."""
+        with self.lock:
+            data = {'files': self.files, 'rows': self.rows}
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(temp_path, self.path)
@@ -1,16 +1,35 @@
+import logging
 import os
 import requests
 import time
 import json
+import uuid
+import threading
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 from pathlib import Path
-from urllib.parse import unquote
+from urllib.parse import unquote, urlparse
+from email.utils import parsedate_to_datetime
+import xml.etree.ElementTree as ET
+from local_watch import LocalChangeWatcher
+from sync_state import SyncStateStore, file_sha1
+import metrics
 
 # Load environment variables from .env file securely
 env_path = Path(__file__).parent / 'env' / '.env'
 load_dotenv(dotenv_path=env_path)
 
+logger = logging.getLogger(__name__)
+
+# Timers and counters for the WebDAV requests, exposed by the metrics endpoint
+PROPFIND_SECONDS = metrics.timer('onboarding_propfind_seconds', 'Duration of PROPFIND requests, by depth.', ('depth',))
+UPLOAD_SECONDS = metrics.timer('onboarding_upload_seconds', 'Duration of file uploads, by mode.', ('mode',))
+UPLOAD_BYTES_TOTAL = metrics.counter('onboarding_upload_bytes_total', 'Bytes uploaded to Nextcloud.')
+UPLOAD_ERRORS_TOTAL = metrics.counter('onboarding_upload_errors_total', 'Failed Nextcloud requests, by operation.', ('operation',))
+
 # Load Nextcloud credentials and base information from the .env file
 NEXTCLOUD_BASE_URL = os.getenv('NEXTCLOUD_BASE_URL').rstrip('/')
 NEXTCLOUD_USERNAME = os.getenv('NEXTCLOUD_USERNAME')
@@ -20,182 +39,635 @@ NEXTCLOUD_DIRECTORY = os.getenv('NEXTCLOUD_DIRECTORY').strip('/')
 # Load the sync interval from the environment or set a default (in seconds)
 SYNC_INTERVAL = int(os.getenv('SYNC_INTERVAL', 60))  # Default is 60 seconds
 
+# 'watch' uploads files as soon as they change, 'poll' rescans the folders every SYNC_INTERVAL seconds
+SYNC_MODE = os.getenv('SYNC_MODE', 'watch').strip().lower()
+# Seconds a changed file must stay untouched before it is uploaded, and the scan interval without inotify
+WATCH_DEBOUNCE = float(os.getenv('WATCH_DEBOUNCE', 1.0))
+WATCH_POLL_INTERVAL = float(os.getenv('WATCH_POLL_INTERVAL', 2.0))
+
+# Number of parallel uploads; the HTTP connection pool is sized to match
+UPLOAD_WORKERS = max(1, int(os.getenv('UPLOAD_WORKERS', 4)))
+# Retries for requests failing with 423 Locked or 5xx, with exponential backoff starting at UPLOAD_RETRY_BACKOFF seconds
+UPLOAD_RETRIES = int(os.getenv('UPLOAD_RETRIES', 5))
+UPLOAD_RETRY_BACKOFF = float(os.getenv('UPLOAD_RETRY_BACKOFF', 1))
+
+# Files of at least this size (in bytes) are uploaded in chunks of CHUNK_SIZE bytes
+CHUNKED_UPLOAD_THRESHOLD = int(os.getenv('CHUNKED_UPLOAD_THRESHOLD', 10 * 1024 * 1024))
+CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', 5 * 1024 * 1024))
+
+# WebDAV root for chunked uploads, derived from .../remote.php/dav/files/<user>
+NEXTCLOUD_UPLOADS_URL = (
+    NEXTCLOUD_BASE_URL.replace('/remote.php/dav/files/', '/remote.php/dav/uploads/', 1)
+    if '/remote.php/dav/files/' in NEXTCLOUD_BASE_URL else None
+)
+
+# Local progress of chunked uploads, so an interrupted transfer can be resumed
+UPLOAD_PROGRESS_FILE = 'upload_progress.json'
+upload_progress_lock = threading.Lock()
+
 # Local folders to sync
 local_folders = {
     'attachments': 'attachments',
     'onboarded_person': 'onboarded_person'
 }
 
-# Local file tracking for uploads
+# Local state of uploaded files, keyed by (local folder, relative path)
+SYNC_STATE_FILE = os.getenv('SYNC_STATE_FILE', 'sync_state.db')
+# Tracking file of earlier versions, imported into the state store once
 TRACKING_FILE = 'file_tracking.json'
 
-def load_tracking_data():
-    """Load the file tracking data from the tracking file."""
-    if os.path.exists(TRACKING_FILE):
-        with open(TRACKING_FILE, 'r') as f:
-            return json.load(f)
-    return {}
+def open_sync_state():
+    """
+    Open the sync state store and import the old tracking file if it is still present.
+
+    Returns:
+        SyncStateStore: The opened store.
+    """
+    state = SyncStateStore(SYNC_STATE_FILE)
+    imported = state.import_tracking_file(TRACKING_FILE, list(local_folders))
+    if imported:
+        logger.info(f"Imported {imported} entries from {TRACKING_FILE} into {SYNC_STATE_FILE}.")
+    return state
+
+# WebDAV properties requested for every listed entry
+PROPFIND_BODY = """<?xml version="1.0" encoding="utf-8"?>
+<d:propfind xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns">
+    <d:prop>
+        <d:getetag/>
+        <d:getcontentlength/>
+        <d:getlastmodified/>
+        <d:resourcetype/>
+        <oc:checksums/>
+    </d:prop>
+</d:propfind>"""
+
+# Listing cache per Nextcloud folder: (folder ETag, entries)
+folder_listing_cache = {}
+
+def parse_sha1_checksum(value):
+    """
+    Extract the SHA-1 hex digest from a Nextcloud checksum list such as 'SHA1:ab12... MD5:cd34...'.
+
+    Args:
+        value (str): The OC-Checksum header or oc:checksum property, or None.
+
+    Returns:
+        str: The lower-case SHA-1 hex digest, or None if the list contains none.
+    """
+    for checksum in (value or '').split():
+        algorithm, _, digest = checksum.partition(':')
+        if algorithm.upper() == 'SHA1' and digest:
+            return digest.lower()
+    return None
+
+def response_etag(response):
+    """Return the ETag Nextcloud reports for an uploaded file, without quotes ('' if there is none)."""
+    etag = response.headers.get('OC-ETag') or response.headers.get('ETag') or ''
+    return etag.strip().strip('"')
+
+def parse_multistatus(stream, folder_path):
+    """
+    Parse a WebDAV multistatus response incrementally.
+
+    Args:
+        stream (file): A file-like object with the XML response body.
+        folder_path (str): The URL path of the listed folder, used to tell the folder's own entry apart.
+
+    Returns:
+        tuple: (ETag of the folder itself or None, dict mapping entry names to their properties).
+    """
+    folder_etag = None
+    entries = {}
+    folder_path = unquote(folder_path).rstrip('/')
+
+    for _, element in ET.iterparse(stream, events=('end',)):
+        if element.tag != '{DAV:}response':
+            continue
+
+        href = unquote(element.findtext('{DAV:}href', default='')).strip()
+        path = urlparse(href).path.rstrip('/')
+        props = {}
+        # Only properties from a 200 propstat are valid; missing ones come back in a 404 propstat
+        for propstat in element.findall('{DAV:}propstat'):
+            if ' 200 ' not in propstat.findtext('{DAV:}status', default=' 200 '):
+                continue
+            prop = propstat.find('{DAV:}prop')
+            if prop is not None:
+                props.update({child.tag: child for child in prop})
+
+        etag = props['{DAV:}getetag'].text if '{DAV:}getetag' in props else None
+        etag = etag.strip().strip('"') if etag else None
+
+        if path == folder_path:
+            folder_etag = etag
+        else:
+            name = path.split('/')[-1]
+            if name:
+                size = props['{DAV:}getcontentlength'].text if '{DAV:}getcontentlength' in props else None
+                last_modified = props['{DAV:}getlastmodified'].text if '{DAV:}getlastmodified' in props else None
+                resourcetype = props.get('{DAV:}resourcetype')
+                checksums = props.get('{http://owncloud.org/ns}checksums')
+                checksum = checksums.findtext('{http://owncloud.org/ns}checksum') if checksums is not None else None
+                entries[name] = {
+                    'name': name,
+                    'size': int(size) if size else None,
+                    'etag': etag,
+                    'last_modified': parsedate_to_datetime(last_modified) if last_modified else None,
+                    'is_dir': resourcetype is not None and resourcetype.find('{DAV:}collection') is not None,
+                    'sha1': parse_sha1_checksum(checksum),
+                }
+
+        # Free the parsed element so memory stays flat for large folders
+        element.clear()
+
+    return folder_etag, entries
+
+def propfind(session, url, depth):
+    """
+    Send a PROPFIND request and parse the multistatus response as it streams in.
+
+    Args:
+        session (requests.Session): The persistent session object.
+        url (str): The URL of the folder to query.
+        depth (str): The Depth header, '0' for the folder itself or '1' to include its children.
 
-def save_tracking_data(data):
-    """Save the file tracking data to the tracking file."""
-    with open(TRACKING_FILE, 'w') as f:
-        json.dump(data, f, indent=4)
+    Returns:
+        tuple: (folder ETag, entries) as returned by parse_multistatus.
+    """
+    headers = {'Depth': depth, 'Content-Type': 'application/xml; charset=utf-8'}
+    with PROPFIND_SECONDS.time(depth=depth), \
+            session.request("PROPFIND", url, headers=headers, data=PROPFIND_BODY, stream=True) as response:
+        if response.status_code != 207:
+            raise Exception(f"PROPFIND on {url} failed. Status code: {response.status_code}")
+        response.raw.decode_content = True
+        return parse_multistatus(response.raw, urlparse(url).path)
 
 def get_nextcloud_files(session, folder_name):
     """
-    Get a list of files from a specific Nextcloud folder using a persistent session.
+    Get the files of a specific Nextcloud folder using a persistent session.
+
+    The folder's ETag is checked first with a cheap Depth:0 request; the full Depth:1 listing is only
+    fetched when the folder changed since the last call.
 
     Args:
         session (requests.Session): The persistent session object.
         folder_name (str): The subfolder name under the group folder on Nextcloud.
         
     Returns:
-        list: A list of filenames from the Nextcloud folder.
+        dict: Maps file names to dicts with 'name', 'size', 'etag', 'last_modified', 'is_dir' and 'sha1'
+        (the SHA-1 checksum Nextcloud stored for the file, if any).
     """
     try:
         nextcloud_url = f"{NEXTCLOUD_BASE_URL}/{NEXTCLOUD_DIRECTORY}/{folder_name}/"
-        print(f"Connecting to Nextcloud folder: {nextcloud_url}")
 
-        # Make a PROPFIND request to list files in the Nextcloud directory
-        headers = {'Depth': '1'}
-        response = session.request("PROPFIND", nextcloud_url, headers=headers)
-
-        if response.status_code != 207:
-            raise Exception(f"Failed to list Nextcloud files in {folder_name}. Status code: {response.status_code}")
-
-        print(f"Successfully retrieved file list from Nextcloud folder: {folder_name}.")
-
-        files = []
-        for line in response.text.split('\n'):
-            if '<d:href>' in line:
-                filename = line.split('<d:href>')[1].split('</d:href>')[0].split('/')[-1]
-                filename = unquote(filename).strip()
-                if filename:
-                    files.append(filename)
+        cached = folder_listing_cache.get(folder_name)
+        if cached is not None:
+            folder_etag, _ = propfind(session, nextcloud_url, '0')
+            if folder_etag is not None and folder_etag == cached[0]:
+                logger.debug(f"Nextcloud folder '{folder_name}' is unchanged, using cached listing of {len(cached[1])} entries.")
+                return cached[1]
+
+        logger.debug(f"Listing Nextcloud folder: {nextcloud_url}")
+        folder_etag, files = propfind(session, nextcloud_url, '1')
+        if folder_etag is not None:
+            folder_listing_cache[folder_name] = (folder_etag, files)
+        else:
+            folder_listing_cache.pop(folder_name, None)
 
-        print(f"Nextcloud '{folder_name}' contains {len(files)} files: {files}")
+        logger.debug(f"Nextcloud '{folder_name}' contains {len(files)} entries.")
         return files
 
     except Exception as e:
-        print(f"Error retrieving files from Nextcloud folder {folder_name}: {e}")
-        return []
+        UPLOAD_ERRORS_TOTAL.inc(operation='propfind')
+        logger.error(f"Error retrieving files from Nextcloud folder {folder_name}: {e}")
+        return {}
 
-def upload_file_to_nextcloud(session, file_path, filename, folder_name):
+def upload_file_to_nextcloud(session, file_path, filename, folder_name, content_hash=None):
     """
     Upload a file to a specific Nextcloud folder using a persistent session.
+
+    Files of CHUNKED_UPLOAD_THRESHOLD bytes or more are sent with the chunked upload protocol.
     
     Args:
         session (requests.Session): The persistent session object.
         file_path (str): The full path to the file to upload.
         filename (str): The name of the file being uploaded.
         folder_name (str): The Nextcloud subfolder where the file should be uploaded.
+        content_hash (str): SHA-1 of the file, sent as OC-Checksum so Nextcloud verifies and stores it.
+
+    Returns:
+        str: The ETag of the uploaded file ('' if the server did not report one), or None if the upload failed.
     """
     try:
         nextcloud_url = f"{NEXTCLOUD_BASE_URL}/{NEXTCLOUD_DIRECTORY}/{folder_name}/{filename}"
-        print(f"Uploading file: {filename} to Nextcloud folder: {folder_name}...")
+        headers = {'OC-Checksum': f"SHA1:{content_hash}"} if content_hash else {}
+
+        file_size = os.path.getsize(file_path)
+
+        if NEXTCLOUD_UPLOADS_URL and file_size >= CHUNKED_UPLOAD_THRESHOLD:
+            with UPLOAD_SECONDS.time(mode='chunked'):
+                etag = upload_file_chunked(session, file_path, filename, nextcloud_url, headers)
+            UPLOAD_BYTES_TOTAL.inc(file_size)
+            return etag
+
+        logger.debug(f"Uploading file: {filename} to Nextcloud folder: {folder_name}...")
 
-        with open(file_path, 'rb') as f:
-            response = session.put(nextcloud_url, data=f)
+        with UPLOAD_SECONDS.time(mode='single'), open(file_path, 'rb') as f:
+            response = session.put(nextcloud_url, data=f, headers=headers)
 
         if response.status_code not in [200, 201, 204]:  # 204 is a valid status code for success
             raise Exception(f"Failed to upload {filename}. Status code: {response.status_code}")
         else:
-            print(f"Successfully uploaded {filename} to Nextcloud folder: {folder_name}.")
-            return True
+            UPLOAD_BYTES_TOTAL.inc(file_size)
+            logger.info(f"Successfully uploaded {filename} to Nextcloud folder: {folder_name}.")
+            return response_etag(response)
 
     except Exception as e:
-        print(f"Error uploading file {filename} to Nextcloud folder {folder_name}: {e}")
-    return False
+        UPLOAD_ERRORS_TOTAL.inc(operation='upload')
+        logger.error(f"Error uploading file {filename} to Nextcloud folder {folder_name}: {e}")
+    return None
+
+def load_upload_progress():
+    """Load the progress of interrupted chunked uploads from the progress file."""
+    if os.path.exists(UPLOAD_PROGRESS_FILE):
+        with open(UPLOAD_PROGRESS_FILE, 'r') as f:
+            return json.load(f)
+    return {}
+
+def save_upload_progress(file_path, progress):
+    """
+    Store (or with progress=None remove) the chunked upload progress of one file.
+
+    Args:
+        file_path (str): The local file the progress belongs to.
+        progress (dict): The progress entry, or None once the upload is finished.
+    """
+    with upload_progress_lock:
+        data = load_upload_progress()
+        if progress is None:
+            data.pop(file_path, None)
+        else:
+            data[file_path] = progress
+        temp_file = f"{UPLOAD_PROGRESS_FILE}.tmp"
+        with open(temp_file, 'w') as f:
+            json.dump(data, f, indent=4)
+        os.replace(temp_file, UPLOAD_PROGRESS_FILE)
 
-def check_for_new_files(session, local_folder, nextcloud_files, nextcloud_folder, tracking_data):
+def upload_file_chunked(session, file_path, filename, destination_url, checksum_headers=None):
+    """
+    Upload a large file with the Nextcloud chunked upload protocol.
+
+    The file is sent as numbered chunks into an upload directory and assembled with a final MOVE.
+    Every confirmed chunk is recorded in UPLOAD_PROGRESS_FILE, so an interrupted upload continues
+    from the last confirmed chunk as long as the local file is unchanged.
+
+    Args:
+        session (requests.Session): The persistent session object.
+        file_path (str): The full path to the file to upload.
+        filename (str): The name of the file being uploaded.
+        destination_url (str): The final WebDAV URL of the file.
+        checksum_headers (dict): OC-Checksum header of the whole file, sent with the final MOVE.
+
+    Returns:
+        str: The ETag of the assembled file ('' if the server did not report one).
+    """
+    stat = os.stat(file_path)
+    total_chunks = max(1, -(-stat.st_size // CHUNK_SIZE))
+    headers = {'Destination': destination_url, 'OC-Total-Length': str(stat.st_size)}
+
+    with upload_progress_lock:
+        progress = load_upload_progress().get(file_path)
+
+    # Resume only if the file and chunk layout are exactly as they were, and the upload directory still exists
+    if progress and (progress['size'], progress['mtime'], progress['chunk_size'], progress['destination']) == (
+            stat.st_size, stat.st_mtime, CHUNK_SIZE, destination_url):
+        upload_dir = f"{NEXTCLOUD_UPLOADS_URL}/{progress['transfer_id']}"
+        response = session.request("PROPFIND", upload_dir, headers={'Depth': '0'})
+        if response.status_code != 207:
+            progress = None
+    else:
+        progress = None
+
+    if progress is None:
+        progress = {
+            'transfer_id': f"upload-{uuid.uuid4().hex}",
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'chunk_size': CHUNK_SIZE,
+            'destination': destination_url,
+            'chunks_done': 0,
+        }
+        upload_dir = f"{NEXTCLOUD_UPLOADS_URL}/{progress['transfer_id']}"
+        response = session.request("MKCOL", upload_dir, headers=headers)
+        if response.status_code not in [200, 201]:
+            raise Exception(f"Failed to create upload directory for {filename}. Status code: {response.status_code}")
+        save_upload_progress(file_path, progress)
+        logger.info(f"Uploading file: {filename} in {total_chunks} chunks...")
+    else:
+        logger.info(f"Resuming upload of {filename} at chunk {progress['chunks_done'] + 1} of {total_chunks}...")
+
+    with open(file_path, 'rb') as f:
+        for chunk_number in range(progress['chunks_done'] + 1, total_chunks + 1):
+            f.seek((chunk_number - 1) * CHUNK_SIZE)
+            chunk = f.read(CHUNK_SIZE)
+            response = session.put(f"{upload_dir}/{chunk_number:05d}", data=chunk, headers=headers)
+            if response.status_code not in [200, 201, 204]:
+                raise Exception(f"Failed to upload chunk {chunk_number} of {filename}. Status code: {response.status_code}")
+            progress['chunks_done'] = chunk_number
+            save_upload_progress(file_path, progress)
+
+    # Assemble the chunks into the destination file
+    response = session.request("MOVE", f"{upload_dir}/.file", headers={**headers, **(checksum_headers or {}), 'Overwrite': 'T'})
+    if response.status_code not in [200, 201, 204]:
+        raise Exception(f"Failed to assemble chunked upload of {filename}. Status code: {response.status_code}")
+
+    save_upload_progress(file_path, None)
+    logger.info(f"Successfully uploaded {filename} in {total_chunks} chunks.")
+    return response_etag(response)
+
+def check_for_new_files(session, local_folder, nextcloud_files, nextcloud_folder, state, files=None):
     """
     Check for new files in the local folder and upload them to Nextcloud using a persistent session.
     
     Args:
         session (requests.Session): The persistent session object.
         local_folder (str): The local folder to check for new files.
-        nextcloud_files (list): The list of files already present in the Nextcloud folder.
+        nextcloud_files (dict): The files already present in the Nextcloud folder, keyed by name, or None
+            when the folder was not listed.
         nextcloud_folder (str): The corresponding Nextcloud folder to upload new files to.
-        tracking_data (dict): The dictionary containing tracked files and their modification times.
+        state (SyncStateStore): The store holding the state of every uploaded file.
+        files (list): Only check these file names instead of scanning the whole folder.
+
+    Returns:
+        bool: True if every new or modified file was uploaded, False if an upload or the check failed.
     """
     try:
-        local_files = os.listdir(local_folder)
-        print(f"Files found in local folder '{local_folder}': {local_files}")
-
-        for file in local_files:
-            file_path = os.path.join(local_folder, file)
-            file_mtime = os.path.getmtime(file_path)
-
-            # Check if the file is new or modified
-            if file not in nextcloud_files and (file not in tracking_data or tracking_data[file] != file_mtime):
-                print(f"New or modified file detected: {file} (from {local_folder})")
-                if upload_file_to_nextcloud(session, file_path, file, nextcloud_folder):
-                    # Update tracking data after successful upload
-                    tracking_data[file] = file_mtime
-            else:
-                print(f"File {file} already exists in Nextcloud folder {nextcloud_folder} or has not been modified. Skipping...")
+        pending = []
+        checked = 0
+        for file, file_path, file_size, file_mtime in iter_local_files(local_folder, files):
+            checked += 1
+            content_hash = detect_change(local_folder, file, file_path, file_size, file_mtime,
+                                         (nextcloud_files or {}).get(file), state)
+            if content_hash is not None:
+                logger.info(f"New or modified file detected: {file} (from {local_folder})")
+                pending.append((file, file_path, file_size, file_mtime, content_hash))
+
+        logger.debug(f"Checked {checked} files in '{local_folder}', {len(pending)} to upload.")
+        if not pending:
+            return True
+
+        # Upload in parallel; the state is only updated here, in the calling thread, as each upload completes
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='upload') as executor:
+            futures = {
+                executor.submit(upload_file_to_nextcloud, session, file_path, file, nextcloud_folder, content_hash):
+                    (file, file_size, file_mtime, content_hash)
+                for file, file_path, file_size, file_mtime, content_hash in pending
+            }
+            failed = 0
+            for future in as_completed(futures):
+                file, file_size, file_mtime, content_hash = futures[future]
+                etag = future.result()
+                if etag is None:
+                    failed += 1
+                else:
+                    # Record the uploaded file right away, so a crash later in the cycle does not upload it again
+                    state.update(local_folder, file, file_size, file_mtime, content_hash, etag or None)
+        return failed == 0
     except Exception as e:
-        print(f"Error checking for new files in {local_folder}: {e}")
+        logger.error(f"Error checking for new files in {local_folder}: {e}")
+    return False
+
+def sync_file(session, state, file_path):
+    """
+    Upload a single file to its Nextcloud folder if it is new or modified.
+
+    Used by the pipeline to upload a letter as soon as it was written, without scanning its folder.
+
+    Args:
+        session (requests.Session): The persistent session object.
+        state (SyncStateStore): The store holding the state of every uploaded file.
+        file_path (str): The file, located directly in one of the local_folders.
+
+    Returns:
+        bool: True if Nextcloud holds the current content of the file afterwards.
+    """
+    folder = os.path.abspath(os.path.dirname(file_path))
+    local_folder = next((name for name in local_folders if os.path.abspath(name) == folder), None)
+    if local_folder is None:
+        logger.warning(f"{file_path} is not in a synchronized folder, skipping upload.")
+        return False
+
+    file = os.path.basename(file_path)
+    stat = os.stat(file_path)
+    content_hash = detect_change(local_folder, file, file_path, stat.st_size, stat.st_mtime, None, state)
+    if content_hash is None:
+        logger.debug(f"{file} is unchanged since its last upload.")
+        return True
+
+    etag = upload_file_to_nextcloud(session, file_path, file, local_folders[local_folder], content_hash)
+    if etag is None:
+        return False
+    state.update(local_folder, file, stat.st_size, stat.st_mtime, content_hash, etag or None)
+    return True
+
+def detect_change(local_folder, file, file_path, file_size, file_mtime, remote, state):
+    """
+    Decide whether a local file has to be uploaded.
+
+    Size and mtime are compared with the stored state first; the file is only hashed when they differ.
+    The hash is then compared with the hash of the last upload and with the SHA-1 checksum Nextcloud
+    reports for the remote copy, so touched but unchanged files are neither hashed again nor re-uploaded.
+
+    Args:
+        local_folder (str): The local folder the file belongs to.
+        file (str): The file name.
+        file_path (str): The full path to the file.
+        file_size (int): The local size in bytes.
+        file_mtime (float): The local modification time.
+        remote (dict): The file's entry from the Nextcloud listing, or None if it is not known there.
+        state (SyncStateStore): The store holding the state of every uploaded file.
+
+    Returns:
+        str: The SHA-1 of the file if it has to be uploaded, otherwise None.
+    """
+    known = state.get(local_folder, file)
+    if known is not None and known.size == file_size and known.mtime == file_mtime:
+        return None
+
+    content_hash = file_sha1(file_path)
+    if known is not None and known.content_hash == content_hash:
+        # Only the mtime changed; remember it so the file is not hashed again
+        state.update(local_folder, file, file_size, file_mtime, content_hash, known.etag)
+        return None
+    if remote is not None and remote['size'] == file_size and remote.get('sha1') == content_hash:
+        # Nextcloud already holds exactly this content
+        state.update(local_folder, file, file_size, file_mtime, content_hash, remote['etag'])
+        return None
+    return content_hash
+
+def iter_local_files(local_folder, files=None):
+    """
+    Yield the regular files of a local folder with their size and modification time.
+
+    Files ending in .tmp are skipped; they are still being written and get renamed into place when finished.
+
+    Args:
+        local_folder (str): The local folder.
+        files (list): Only these file names; None scans the folder with a single os.scandir pass.
 
-def sync_folders(session):
+    Yields:
+        tuple: (file name, file path, size, modification time).
+    """
+    if files is None:
+        with os.scandir(local_folder) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    yield entry.name, entry.path, stat.st_size, stat.st_mtime
+        return
+
+    for file in files:
+        if file.endswith('.tmp'):
+            continue
+        file_path = os.path.join(local_folder, file)
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            continue
+        yield file, file_path, stat.st_size, stat.st_mtime
+
+def sync_folders(session, state):
     """
     Check local folders for new files and upload them to the corresponding Nextcloud folders using a persistent session.
     
     Args:
         session (requests.Session): The persistent session object.
-    """
-    tracking_data = load_tracking_data()
+        state (SyncStateStore): The store holding the state of every uploaded file.
 
+    Returns:
+        bool: True if every new or modified file was uploaded, False if any upload failed.
+    """
     try:
+        uploaded = True
         for local_folder, nextcloud_folder in local_folders.items():
-            print(f"Checking local folder: {local_folder} for new files...")
-            folder_path = os.path.abspath(local_folder)
-            print(f"Local folder path: {folder_path}")
+            logger.debug(f"Checking local folder: {local_folder} for new files...")
 
             if not os.path.exists(local_folder):
-                print(f"Local folder {local_folder} does not exist. Skipping...")
+                logger.warning(f"Local folder {local_folder} does not exist. Skipping...")
                 continue
 
             # Get a list of files in the corresponding Nextcloud folder
             nextcloud_files = get_nextcloud_files(session, nextcloud_folder)
 
             # Check for new files in the local folder and upload them
-            check_for_new_files(session, local_folder, nextcloud_files, nextcloud_folder, tracking_data)
-
-        # Save updated tracking data
-        save_tracking_data(tracking_data)
+            uploaded = check_for_new_files(session, local_folder, nextcloud_files, nextcloud_folder, state) and uploaded
+        return uploaded
 
     except Exception as e:
-        print(f"Error during folder synchronization: {e}")
+        logger.error(f"Error during folder synchronization: {e}")
+    return False
 
-def countdown_timer(seconds):
+def create_session():
     """
-    Countdown timer that displays the remaining time before the next sync.
-    
-    Args:
-        seconds (int): The number of seconds to count down.
+    Create the persistent, authenticated session used for all Nextcloud requests.
+
+    The connection pool is sized for UPLOAD_WORKERS parallel uploads, and requests that fail with
+    423 Locked or a 5xx status are retried with exponential backoff.
+
+    Returns:
+        requests.Session: The configured session.
+    """
+    session = requests.Session()
+    # Set up authentication for the session
+    session.auth = HTTPBasicAuth(NEXTCLOUD_USERNAME, NEXTCLOUD_PASSWORD)
+
+    retries = Retry(
+        total=UPLOAD_RETRIES,
+        backoff_factor=UPLOAD_RETRY_BACKOFF,
+        status_forcelist=(423, 500, 502, 503, 504),
+        allowed_methods=frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'PROPFIND', 'MKCOL', 'MOVE']),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=UPLOAD_WORKERS, max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def sync_once():
+    """
+    Synchronize all local folders once and return, e.g. when run from a cron job or systemd timer.
+
+    Returns:
+        bool: True if every new or modified file was uploaded.
     """
-    for i in range(seconds, 0, -1):
-        print(f"Next sync in {i} seconds...", end='\r')
-        time.sleep(1)
-    print("Starting sync now...")
+    with create_session() as session, open_sync_state() as state:
+        uploaded = sync_folders(session, state)
+        if uploaded:
+            logger.info("Synchronization complete.")
+        else:
+            logger.warning("Synchronization finished, but some files could not be uploaded.")
+        return uploaded
 
-def start_periodic_sync():
+def create_local_folders():
     """
-    Start the periodic synchronization of local folders to Nextcloud.
-    The synchronization interval is specified in the .env file or defaults to 60 seconds.
+    Create the local folders that are synchronized.
+
+    They otherwise only appear once the first file is written to them; created up front, they can all be
+    watched with inotify and full synchronizations do not skip them.
     """
-    # Use a persistent session for Nextcloud requests
-    with requests.Session() as session:
-        # Set up authentication for the session
-        session.auth = HTTPBasicAuth(NEXTCLOUD_USERNAME, NEXTCLOUD_PASSWORD)
+    for local_folder in local_folders:
+        os.makedirs(local_folder, exist_ok=True)
 
-        while True:
-            print("Starting folder synchronization...")
-            sync_folders(session)
-            print("Synchronization complete.")
-            countdown_timer(SYNC_INTERVAL)  # Wait for the specified sync interval
+def run_sync_service():
+    """
+    Keep the Nextcloud folders synchronized until interrupted.
+
+    With SYNC_MODE 'watch', the local folders are watched with inotify (or cheap os.scandir diffing where inotify
+    is unavailable) and changed files are uploaded as soon as they have been written. The watcher is started before
+    the initial full synchronization, so files written while it runs are reported as well. A full synchronization
+    every SYNC_INTERVAL seconds retries failed uploads and catches anything the watcher missed; with SYNC_MODE
+    'poll' it is the only synchronization.
+    """
+    create_local_folders()
+    with create_session() as session, open_sync_state() as state:
+        watcher = None
+        if SYNC_MODE == 'watch':
+            watcher = LocalChangeWatcher(list(local_folders), debounce=WATCH_DEBOUNCE, poll_interval=WATCH_POLL_INTERVAL)
+        folder_names = {os.path.abspath(local_folder): local_folder for local_folder in local_folders}
+        try:
+            logger.info("Starting initial folder synchronization...")
+            sync_folders(session, state)
+            next_rescan = time.monotonic() + SYNC_INTERVAL
+
+            if watcher is not None:
+                logger.info(f"Watching {', '.join(local_folders)} for changes using {watcher.mode}...")
+            else:
+                logger.info(f"Synchronizing {', '.join(local_folders)} every {SYNC_INTERVAL} seconds...")
+            while True:
+                timeout = max(0.0, next_rescan - time.monotonic())
+                if watcher is not None:
+                    changes = watcher.poll(timeout)
+                else:
+                    time.sleep(timeout)
+                    changes = []
+
+                changed_files = {}
+                for folder, file in changes:
+                    changed_files.setdefault(folder_names[folder], []).append(file)
+
+                for local_folder, files in changed_files.items():
+                    # The changed files are known, so the remote listing is not needed to pick them
+                    check_for_new_files(session, local_folder, None, local_folders[local_folder], state, files)
+
+                if time.monotonic() >= next_rescan:
+                    logger.debug("Starting periodic full folder synchronization...")
+                    sync_folders(session, state)
+                    next_rescan = time.monotonic() + SYNC_INTERVAL
+        finally:
+            if watcher is not None:
+                watcher.close()
 
 if __name__ == "__main__":
-    print("Starting periodic folder synchronization service with a persistent session...")
-    start_periodic_sync()
+    metrics.setup_logging()
+    metrics.start_metrics_server()
+    run_sync_service()
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+# What is known about a local file since its last successful upload
+FileState = namedtuple('FileState', ['size', 'mtime', 'content_hash', 'etag'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    folder TEXT NOT NULL,
+    relpath TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    content_hash TEXT,
+    etag TEXT,
+    uploaded_at TEXT NOT NULL,
+    PRIMARY KEY (folder, relpath)
+) WITHOUT ROWID
+"""
+
+
+def file_sha1(file_path):
+    """Return the SHA-1 hex digest of a file's content, the checksum Nextcloud keeps in OC-Checksum."""
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SyncStateStore:
+    """
+    Transactional store of the files that were uploaded to Nextcloud.
+
+    Entries live in an SQLite database in WAL mode and are keyed by (local folder, relative path), so
+    files with the same name in different folders no longer collide. Lookups and updates touch a single
+    row, so the cost of a sync cycle does not grow with the number of tracked files, and a crash in the
+    middle of a write never corrupts the state.
+
+    Args:
+        path (str): Location of the SQLite database file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # In WAL mode NORMAL is still crash safe; only the last commits may be lost on power failure
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute(SCHEMA)
+
+    def close(self):
+        """Close the database connection."""
+        with self.lock:
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, folder, relpath):
+        """
+        Look up the state of one file.
+
+        Args:
+            folder (str): The local folder the file belongs to.
+            relpath (str): The file's path relative to that folder.
+
+        Returns:
+            FileState: The stored state, or None if the file was never uploaded.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT size, mtime, content_hash, etag FROM files WHERE folder = ? AND relpath = ?',
+                (folder, relpath)).fetchone()
+        return FileState(*row) if row else None
+
+    def update(self, folder, relpath, size, mtime, content_hash=None, etag=None):
+        """Store the state of a file after it was uploaded."""
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT INTO files (folder, relpath, size, mtime, content_hash, etag, uploaded_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (folder, relpath) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, '
+                'content_hash = excluded.content_hash, etag = excluded.etag, uploaded_at = excluded.uploaded_at',
+                (folder, relpath, size, mtime, content_hash, etag, datetime.now().isoformat(timespec='seconds')))
+
+    def remove(self, folder, relpath):
+        """Forget a file, e.g. after it was deleted locally."""
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM files WHERE folder = ? AND relpath = ?', (folder, relpath))
+
+    def import_tracking_file(self, tracking_file, folders):
+        """
+        Migrate the old file_tracking.json (bare file name -> mtime) into the store.
+
+        The old file did not record which folder a name belonged to, so every folder that currently contains
+        a file of that name gets the entry. The JSON file is renamed afterwards so the import runs only once.
+
+        Args:
+            tracking_file (str): Path of the old JSON tracking file.
+            folders (list): The local folders to look the tracked names up in.
+
+        Returns:
+            int: Number of entries imported.
+        """
+        if not os.path.exists(tracking_file):
+            return 0
+        with open(tracking_file, 'r') as f:
+            tracking_data = json.load(f)
+
+        rows = []
+        uploaded_at = datetime.now().isoformat(timespec='seconds')
+        for name, mtime in tracking_data.items():
+            for folder in folders:
+                try:
+                    size = os.stat(os.path.join(folder, name)).st_size
+                except FileNotFoundError:
+                    continue
+                rows.append((folder, name, size, mtime, None, None, uploaded_at))
+
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO files (folder, relpath, size, mtime, content_hash, etag, uploaded_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        os.replace(tracking_file, f"{tracking_file}.migrated")
+        return len(rows)
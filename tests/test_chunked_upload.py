@@ -0,0 +1,81 @@
+import json
+import os
+
+import pytest
+import requests
+
+import syn_nextcloud
+from benchmark_servers import WebDavStandIn
+
+CHUNK_SIZE = 1024
+
+
+@pytest.fixture
+def webdav():
+    server = WebDavStandIn()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def upload(webdav, tmp_path, monkeypatch):
+    """Point the chunked upload at the stand-in with small chunks and a progress file in tmp_path."""
+    base_url = webdav.base_url('onboarding')
+    monkeypatch.setattr(syn_nextcloud, 'NEXTCLOUD_UPLOADS_URL', base_url.replace('/dav/files/', '/dav/uploads/'))
+    monkeypatch.setattr(syn_nextcloud, 'CHUNK_SIZE', CHUNK_SIZE)
+    monkeypatch.setattr(syn_nextcloud, 'UPLOAD_PROGRESS_FILE', str(tmp_path / 'upload_progress.json'))
+
+    source = tmp_path / 'letters.pdf'
+    source.write_bytes(os.urandom(5 * CHUNK_SIZE + 100))
+    destination = f'{base_url}/Onboarding/onboarded_person/letters.pdf'
+    # A plain session, so a failed request is not retried by the session's own retry policy
+    with requests.Session() as session:
+        yield session, str(source), destination
+
+
+def test_chunked_upload_assembles_file(webdav, upload):
+    session, source, destination = upload
+
+    etag = syn_nextcloud.upload_file_chunked(session, source, 'letters.pdf', destination)
+
+    stored = webdav.files['/remote.php/dav/files/onboarding/Onboarding/onboarded_person/letters.pdf']
+    assert stored['data'] == open(source, 'rb').read()
+    assert etag == stored['etag']
+    assert syn_nextcloud.load_upload_progress() == {}
+
+
+def test_chunked_upload_resumes_after_failed_chunk(webdav, upload):
+    session, source, destination = upload
+    requests_seen = []
+    failed = []
+
+    def fail_third_chunk_once(method, path):
+        requests_seen.append((method, path.rsplit('/', 1)[-1]))
+        if method == 'PUT' and path.endswith('/00003') and not failed:
+            failed.append(path)
+            return 503
+        return None
+
+    webdav.fail_hook = fail_third_chunk_once
+
+    with pytest.raises(Exception, match='chunk 3'):
+        syn_nextcloud.upload_file_chunked(session, source, 'letters.pdf', destination)
+
+    # The two confirmed chunks are recorded, so the next attempt continues from there
+    with open(syn_nextcloud.UPLOAD_PROGRESS_FILE) as f:
+        progress = json.load(f)[source]
+    assert progress['chunks_done'] == 2
+
+    del requests_seen[:]
+    syn_nextcloud.upload_file_chunked(session, source, 'letters.pdf', destination)
+
+    # Only the upload directory is checked again; chunks 1 and 2 are not sent a second time
+    assert requests_seen == [
+        ('PROPFIND', progress['transfer_id']),
+        ('PUT', '00003'), ('PUT', '00004'), ('PUT', '00005'), ('PUT', '00006'),
+        ('MOVE', '.file'),
+    ]
+    stored = webdav.files['/remote.php/dav/files/onboarding/Onboarding/onboarded_person/letters.pdf']
+    assert stored['data'] == open(source, 'rb').read()
+    assert webdav.bytes_received == os.path.getsize(source)
+    assert syn_nextcloud.load_upload_progress() == {}
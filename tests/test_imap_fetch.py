@@ -0,0 +1,162 @@
+import imaplib
+import io
+
+import pytest
+
+from benchmark_servers import ImapStandIn
+from imap_fetch import decode_part_to_file, find_csv_parts, parse_fetch_response
+
+CSV_BYTES = 'Vorname und Nachname;Abteilung\r\nMax Müller;IT\r\n'.encode('utf-8')
+
+
+def literal(prefix, payload):
+    """Build the (prefix, literal) tuple imaplib returns for a literal in a FETCH response."""
+    return (prefix + b' {%d}' % len(payload), payload)
+
+
+def parse_structure(text):
+    """Parse a BODYSTRUCTURE written in IMAP syntax."""
+    return parse_fetch_response([f'1 (BODYSTRUCTURE {text})'.encode()])[0]['BODYSTRUCTURE']
+
+
+def test_parse_fetch_response_with_literals():
+    header = b'Subject: Onboarding\r\n\r\n'
+    data = [literal(b'1 (UID 7 BODY[HEADER.FIELDS (SUBJECT)]', header), b')']
+
+    assert parse_fetch_response(data) == [{'UID': b'7', 'BODY[HEADER.FIELDS (SUBJECT)]': header}]
+
+
+def test_parse_fetch_response_with_several_messages():
+    data = [
+        literal(b'1 (UID 3 BODY.PEEK[2]', b'first'), b')',
+        literal(b'2 (UID 4 BODY[2]', b'(not a list)'), b')',
+    ]
+
+    messages = parse_fetch_response(data)
+
+    assert [message['UID'] for message in messages] == [b'3', b'4']
+    assert messages[0]['BODY[2]'] == b'first'
+    assert messages[1]['BODY[2]'] == b'(not a list)'
+
+
+def test_parse_fetch_response_quoted_strings_and_nil():
+    structure = parse_structure(r'("text" "csv" ("name" "a \"b\".csv") NIL NIL "7bit" 10 1 NIL NIL NIL NIL)')
+
+    assert structure == [b'text', b'csv', [b'name', b'a "b".csv'], None, None, b'7bit', b'10', b'1',
+                         None, None, None, None]
+
+
+def test_find_csv_parts_attachment():
+    structure = parse_structure(
+        '(("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 20 1 NIL NIL NIL NIL)'
+        '("text" "csv" ("name" "export.csv") NIL NIL "base64" 120 2 NIL ("attachment" ("filename" "export.csv")) NIL NIL)'
+        '("application" "pdf" ("name" "letter.pdf") NIL NIL "base64" 900 NIL ("attachment" ("filename" "letter.pdf")) NIL NIL)'
+        ' "mixed" NIL NIL NIL NIL)'
+    )
+
+    parts = find_csv_parts(structure)
+
+    assert len(parts) == 1
+    assert parts[0]['section'] == '2'
+    assert parts[0]['filename'] == 'export.csv'
+    assert parts[0]['encoding'] == 'base64'
+    assert parts[0]['size'] == 120
+    assert parts[0]['disposition'] == 'attachment'
+
+
+def test_find_csv_parts_by_filename_or_content_type():
+    structure = parse_structure(
+        '(("application" "octet-stream" NIL NIL NIL "base64" 80 NIL ("attachment" ("filename" "Export.CSV")) NIL NIL)'
+        '("application" "csv" NIL NIL NIL "7bit" 40 NIL NIL NIL NIL)'
+        '("application" "octet-stream" NIL NIL NIL "base64" 80 NIL ("attachment" ("filename" "export.xlsx")) NIL NIL)'
+        ' "mixed" NIL NIL NIL NIL)'
+    )
+
+    parts = find_csv_parts(structure)
+
+    assert [(part['section'], part['filename']) for part in parts] == [('1', 'Export.CSV'), ('2', None)]
+
+
+def test_find_csv_parts_decodes_filenames():
+    structure = parse_structure(
+        '(("application" "octet-stream" NIL NIL NIL "base64" 80 NIL'
+        ' ("attachment" ("filename*" "utf-8\'\'Mitarbeiter%C3%BC.csv")) NIL NIL)'
+        '("text" "plain" ("name" "=?utf-8?q?Liste_=C3=BC.csv?=") NIL NIL "base64" 80 1 NIL NIL NIL NIL)'
+        ' "mixed" NIL NIL NIL NIL)'
+    )
+
+    assert [part['filename'] for part in find_csv_parts(structure)] == ['Mitarbeiterü.csv', 'Liste ü.csv']
+
+
+def test_find_csv_parts_in_forwarded_message():
+    envelope = '(' + ' '.join(['NIL'] * 10) + ')'
+    structure = parse_structure(
+        '(("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 20 1 NIL NIL NIL NIL)'
+        f'("message" "rfc822" NIL NIL NIL "7bit" 400 {envelope}'
+        ' (("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 20 1 NIL NIL NIL NIL)'
+        '("text" "csv" ("name" "export.csv") NIL NIL "quoted-printable" 60 2 NIL ("attachment" ("filename" "export.csv")) NIL NIL)'
+        ' "mixed" NIL NIL NIL NIL) 12 NIL NIL NIL NIL)'
+        ' "mixed" NIL NIL NIL NIL)'
+    )
+
+    parts = find_csv_parts(structure)
+
+    assert [(part['section'], part['encoding']) for part in parts] == [('2.2', 'quoted-printable')]
+
+
+@pytest.fixture
+def imap_server():
+    server = ImapStandIn()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def mail(imap_server):
+    connection = imaplib.IMAP4('127.0.0.1', imap_server.port)
+    connection.login('onboarding', 'secret')
+    connection.select('INBOX')
+    yield connection
+    connection.logout()
+
+
+def test_fetch_csv_attachment_from_server(imap_server, mail):
+    uid = imap_server.add_csv_message('Onboarding export', 'export.csv', CSV_BYTES)
+
+    status, data = mail.uid('FETCH', str(uid), '(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (SUBJECT)])')
+    assert status == 'OK'
+    message = parse_fetch_response(data)[0]
+    assert message['UID'] == str(uid).encode()
+    assert message['BODY[HEADER.FIELDS (SUBJECT)]'].startswith(b'Subject: Onboarding export')
+
+    parts = find_csv_parts(message['BODYSTRUCTURE'])
+    assert [(part['section'], part['filename']) for part in parts] == [('2', 'export.csv')]
+
+    section = parts[0]['section']
+    status, data = mail.uid('FETCH', str(uid), f'(BODY.PEEK[{section}])')
+    assert status == 'OK'
+    output = io.BytesIO()
+    decode_part_to_file(parse_fetch_response(data)[0][f'BODY[{section}]'], parts[0]['encoding'], output)
+    assert output.getvalue() == CSV_BYTES
+
+
+def test_process_unseen_emails_hands_over_every_attachment(imap_server, mail):
+    import main
+
+    first = imap_server.add_csv_message('First export', 'first.csv', CSV_BYTES)
+    second = imap_server.add_csv_message('Second export', 'second.csv', CSV_BYTES.replace(b'IT', b'HR'))
+    received = []
+
+    def handle_attachment(payload, part):
+        output = io.BytesIO()
+        decode_part_to_file(payload, part['encoding'], output)
+        received.append((part['filename'], output.getvalue()))
+
+    main.process_unseen_emails(mail, handle_attachment)
+
+    assert received == [('first.csv', CSV_BYTES), ('second.csv', CSV_BYTES.replace(b'IT', b'HR'))]
+    assert imap_server.messages[first]['seen'] and imap_server.messages[second]['seen']
+
+    # Nothing is handed over again once the emails are marked as read
+    main.process_unseen_emails(mail, handle_attachment)
+    assert len(received) == 2